@@ -0,0 +1,44 @@
+# Микробенчмарк проверки IP для /ping: старая схема (список сетей, разбор на
+# каждый запрос) против IpAllowlist с bisect по заранее собранной таблице.
+# Запуск: python benchmarks/ip_allowlist.py
+import os
+import sys
+import ipaddress
+import timeit
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiohttp.test_utils import make_mocked_request
+
+import main
+
+ADDRESSES = {
+    "allowed (first range)": "34.210.12.1",
+    "allowed (last range)": "54.218.200.7",
+    "denied": "8.8.8.8",
+}
+
+def old_check(address):
+    for ip_range in main.DEFAULT_PING_ALLOWLIST:
+        if ipaddress.ip_address(address) in ipaddress.ip_network(ip_range):
+            return True
+    return False
+
+def new_check(address):
+    return address in main.ping_allowlist
+
+def bench(func, *args, number=20000):
+    return min(timeit.repeat(lambda: func(*args), number=number, repeat=5)) / number * 1e6
+
+def run():
+    print(f"{'case':<24}{'old, us':>10}{'new, us':>10}")
+    for name, address in ADDRESSES.items():
+        assert old_check(address) == new_check(address)
+        print(f"{name:<24}{bench(old_check, address):>10.2f}{bench(new_check, address):>10.2f}")
+
+    request = make_mocked_request("GET", "/ping", headers={"X-Forwarded-For": "1.2.3.4, 10.0.0.1, 34.210.12.1"})
+    print(f"{'client_ip (3-hop XFF)':<24}{'':>10}{bench(main.client_ip, request):>10.2f}")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,276 @@
+# Нагрузочный тест всего приложения: aiohttp-приложение из main.create_app()
+# принимает вебхуки от N виртуальных участников, Telegram Bot API подменен
+# локальным сервером, Google Sheets - листом в памяти. Каждый участник проходит
+# опрос целиком: /start -> язык -> имя -> email -> согласие -> категория ->
+# сложность -> 6 ответов, и считается завершившим, когда ему ушел QR.
+# Запуск: python benchmarks/loadtest.py --users 200 --ramp 10
+# Лимиты исходящих запросов берутся из тех же переменных окружения, что и в боте
+# (TG_GLOBAL_RATE, TG_CHAT_RATE, ...), паузу между вопросами задает --question-delay.
+import os
+import sys
+import re
+import json
+import time
+import asyncio
+import logging
+import argparse
+import itertools
+import tempfile
+from collections import Counter, defaultdict
+
+WORKDIR = tempfile.mkdtemp(prefix="loadtest-")
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ.setdefault("FSM_DB", os.path.join(WORKDIR, "fsm.db"))
+os.environ.setdefault("RESULTS_DB", os.path.join(WORKDIR, "results.db"))
+os.environ.setdefault("MEDIA_CACHE_PATH", os.path.join(WORKDIR, "media_cache.json"))
+# Ни вебхук, ни polling не включаем: апдейты шлет сам тест
+os.environ.setdefault("POLLING_ENABLED", "0")
+os.environ.pop("RENDER_EXTERNAL_URL", None)
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import aiohttp
+from aiohttp import web
+from aiogram.client.telegram import TelegramAPIServer
+
+import main
+
+# Журнал доступа на каждый запрос забивает вывод и сам по себе тормозит прогон
+logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+
+STEPS = ("start_cmd", "lang_cb", "name_msg", "email_msg", "consent_cb", "category_cb", "difficulty_cb")
+QUESTIONS_PER_QUIZ = 6
+INLINE_METHOD = re.compile(rb'name="method"\r\n(?:[^\r\n]*\r\n)*?\r\n(\w+)')
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+# Что бот успел показать конкретному чату
+class ChatProgress:
+    def __init__(self):
+        self.question = -1
+        self.done = False
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait(self, predicate, timeout):
+        async with asyncio.timeout(timeout):
+            while not predicate(self):
+                await self.changed.wait()
+
+# Подмена Bot API: отвечает как Telegram и запоминает, какую клавиатуру
+# ответов и какие файлы получил каждый чат
+class FakeTelegramAPI:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+        self.inline_calls = Counter()
+        self.chats = defaultdict(ChatProgress)
+        self.message_ids = itertools.count(1000)
+
+    def record(self, method, params):
+        chat = self.chats[int(params.get("chat_id") or 0)]
+        markup = params.get("reply_markup")
+        if markup:
+            for row in json.loads(markup).get("inline_keyboard", ()):
+                for button in row:
+                    data = button.get("callback_data") or ""
+                    if data.startswith("ans_"):
+                        chat.question = max(chat.question, int(data.split("_")[1]))
+        if method == "sendPhoto":
+            chat.done = True
+        chat.notify()
+
+    def message(self, method, params):
+        message = {
+            "message_id": int(params.get("message_id") or next(self.message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "bot"},
+            "text": params.get("text") or params.get("caption") or "",
+        }
+        if method == "sendPhoto":
+            message["photo"] = [{"file_id": f"PHOTO{message['message_id']}", "file_unique_id": "qr", "width": 1, "height": 1}]
+        return message
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = {key: value for key, value in (await request.post()).items() if isinstance(value, str)}
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.record(method, params)
+        if method.startswith(("send", "edit")):
+            return web.json_response({"ok": True, "result": self.message(method, params)})
+        return web.json_response({"ok": True, "result": True})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+# Лист в памяти вместо gspread: те же вызовы, что делает бот
+class FakeWorksheet:
+    def __init__(self, latency):
+        self.latency = latency
+        self.rows = [list(main.SHEET_HEADER)]
+        self.calls = Counter()
+
+    def call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def row_values(self, row):
+        self.call("row_values")
+        return self.rows[row - 1] if len(self.rows) >= row else []
+
+    def col_values(self, col):
+        self.call("col_values")
+        return [row[col - 1] for row in self.rows]
+
+    def get(self, cells):
+        self.call("get")
+        start = int(re.match(r"A(\d+):A", cells).group(1))
+        return [[row[0]] for row in self.rows[start - 1:]]
+
+    def append_row(self, row, **kwargs):
+        self.call("append_row")
+        self.rows.append(list(row))
+
+    def append_rows(self, rows, **kwargs):
+        self.call("append_rows")
+        self.rows.extend(list(row) for row in rows)
+
+class VirtualUsers:
+    def __init__(self, session, url, api, timeout):
+        self.session = session
+        self.url = url
+        self.api = api
+        self.timeout = timeout
+        self.update_ids = itertools.count(1)
+        self.latency = defaultdict(list)
+        self.errors = Counter()
+        self.completed = 0
+
+    def update(self, uid, text=None, data=None):
+        update_id = next(self.update_ids)
+        user = {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+        chat = {"id": uid, "type": "private"}
+        if data is None:
+            message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": text}
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+            return {"update_id": update_id, "message": message}
+        bot_message = {"message_id": update_id, "date": int(time.time()), "chat": chat,
+                       "from": {"id": 123456, "is_bot": True, "first_name": "bot"}, "text": "..."}
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "chat_instance": str(uid), "from": user, "message": bot_message, "data": data}}
+
+    async def post(self, step, update):
+        headers = {"X-Telegram-Bot-Api-Secret-Token": main.WEBHOOK_SECRET}
+        start = time.perf_counter()
+        async with self.session.post(self.url, json=update, headers=headers) as response:
+            body = await response.read()
+        self.latency[step].append(time.perf_counter() - start)
+        if response.status != 200:
+            self.errors[f"{step}: HTTP {response.status}"] += 1
+            return
+        # Вызов, отданный прямо в ответе на вебхук, Telegram выполнил бы сам
+        match = INLINE_METHOD.search(body)
+        if match:
+            self.api.inline_calls[match.group(1).decode()] += 1
+
+    async def run(self, uid):
+        chat = self.api.chats[uid]
+        try:
+            for step, update in zip(STEPS, (
+                self.update(uid, text="/start"),
+                self.update(uid, data="lang_ru"),
+                self.update(uid, text=f"Участник {uid}"),
+                self.update(uid, text=f"user{uid}@example.com"),
+                self.update(uid, data="consent_yes"),
+                self.update(uid, data="cat_eco"),
+                self.update(uid, data="diff_easy"),
+            )):
+                await self.post(step, update)
+            for q in range(QUESTIONS_PER_QUIZ):
+                await chat.wait(lambda c: c.question >= q, self.timeout)
+                await self.post("answer_cb", self.update(uid, data=f"ans_{q}_0"))
+            await chat.wait(lambda c: c.done, self.timeout)
+            self.completed += 1
+        except TimeoutError:
+            self.errors["timeout waiting for bot"] += 1
+
+async def run_load(args):
+    api = FakeTelegramAPI(args.api_latency)
+    api_runner = web.AppRunner(api.app())
+    await api_runner.setup()
+    await web.TCPSite(api_runner, "127.0.0.1", args.api_port).start()
+    main.bot.session.api = TelegramAPIServer.from_base(f"http://127.0.0.1:{args.api_port}")
+
+    sheet = FakeWorksheet(args.sheets_latency)
+    main.sheets._sheet = sheet
+    main.participants.sync(sheet)
+    main.NEXT_QUESTION_DELAY = args.question_delay
+
+    app_runner = web.AppRunner(main.create_app())
+    await app_runner.setup()
+    await web.TCPSite(app_runner, "127.0.0.1", args.port).start()
+
+    url = f"http://127.0.0.1:{args.port}{main.WEBHOOK_PATH}"
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        users = VirtualUsers(session, url, api, args.timeout)
+        start = time.perf_counter()
+        tasks = []
+        for i in range(args.users):
+            tasks.append(asyncio.create_task(users.run(10**9 + i)))
+            if args.ramp:
+                await asyncio.sleep(args.ramp / args.users)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    # Дожидаемся, пока журнал выгрузит результаты в "таблицу"
+    await main.results_journal.replicate()
+    await app_runner.cleanup()
+    await api_runner.cleanup()
+    return users, api, sheet, elapsed
+
+def report(users, api, sheet, elapsed):
+    updates = sum(len(values) for values in users.latency.values())
+    print(f"users completed: {users.completed}, elapsed {elapsed:.1f}s")
+    print(f"throughput: {updates / elapsed:.1f} updates/s, {users.completed / elapsed:.2f} quizzes/s")
+    print(f"\n{'handler':<16}{'count':>8}{'p50, ms':>10}{'p99, ms':>10}")
+    for step in STEPS + ("answer_cb",):
+        values = users.latency[step]
+        print(f"{step:<16}{len(values):>8}{percentile(values, 0.5) * 1000:>10.1f}{percentile(values, 0.99) * 1000:>10.1f}")
+    print(f"\n{'method':<24}{'outbound':>10}{'inline':>10}")
+    for method in sorted(api.calls.keys() | api.inline_calls.keys()):
+        print(f"{method:<24}{api.calls[method]:>10}{api.inline_calls[method]:>10}")
+    print(f"\nsheets calls: {dict(sheet.calls)}, rows written: {len(sheet.rows) - 1}")
+    if users.errors:
+        print(f"errors: {dict(users.errors)}")
+
+def run():
+    parser = argparse.ArgumentParser(description="End-to-end webhook load test")
+    parser.add_argument("--users", type=int, default=50, help="virtual users")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds to start all users")
+    parser.add_argument("--connections", type=int, default=100, help="client connection pool size")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="fake Bot API latency, s")
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="fake Sheets call latency, s")
+    parser.add_argument("--question-delay", type=float, default=main.NEXT_QUESTION_DELAY, help="pause between questions, s")
+    parser.add_argument("--timeout", type=float, default=120, help="max wait for a bot reply, s")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--api-port", type=int, default=18081)
+    args = parser.parse_args()
+    report(*asyncio.run(run_load(args)))
+
+if __name__ == "__main__":
+    run()
@@ -1,675 +1,1291 @@
 import os
+import sys
 import logging
 import asyncio
-import tempfile
+import io
 import random
-from datetime import datetime
-from aiohttp import web
+import secrets
+import hashlib
+import heapq
+import itertools
+import functools
+import contextvars
+import json
+import sqlite3
+import threading
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+# Отсчет времени холодного старта; стандартная библиотека грузится мгновенно
+STARTUP_BEGIN = time.perf_counter()
+
+from aiohttp import web, FormData, ClientSession, ClientTimeout, ClientError, TCPConnector
 import ipaddress
+import bisect
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.types import (
-    Message, CallbackQuery, FSInputFile,
+    Message, CallbackQuery, FSInputFile, BufferedInputFile, ErrorEvent,
     InlineKeyboardMarkup, InlineKeyboardButton
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
+from aiogram.methods import TelegramMethod
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-import gspread
-from google.oauth2.service_account import Credentials
-
-import qrcode
-from PIL import Image
+# gspread, google-auth и qrcode импортируются лениво, при первом обращении:
+# вместе они грузятся дольше, чем весь остальной бот, а нужны не сразу
 
 # ============== НАСТРОЙКИ ==============
-logging.basicConfig(level=logging.INFO)
+# Воркеры многопроцессного режима помечают свои строки лога номером
+logging.basicConfig(
+    level=logging.INFO,
+    format=f"%(levelname)s:worker-{os.environ['WORKER_ID']}:%(name)s:%(message)s"
+    if "WORKER_ID" in os.environ else logging.BASIC_FORMAT,
+)
+
+# Этапы холодного старта: время каждого этапа от конца предыдущего
+class StartupTimer:
+    def __init__(self, begin):
+        self.begin = begin
+        self.last = begin
+        self.stages = []
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def elapsed(self):
+        return time.perf_counter() - self.begin
+
+    def log(self):
+        breakdown = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in self.stages)
+        logging.info(f"⏱ Startup took {self.elapsed():.2f}s: {breakdown}")
+
+startup_timer = StartupTimer(STARTUP_BEGIN)
+startup_timer.mark("imports")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL")
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = f"{RENDER_EXTERNAL_URL}{WEBHOOK_PATH}" if RENDER_EXTERNAL_URL else None
-WEB_SERVER_HOST = "0.0.0.0"
+# Секрет вебхука; по умолчанию выводится из токена, чтобы совпадать у всех воркеров
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or (
+    hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32] if BOT_TOKEN else None
+)
+WEB_SERVER_HOST = os.getenv("WEB_SERVER_HOST", "0.0.0.0")
 WEB_SERVER_PORT = int(os.getenv("PORT", 8000))
 TARGET_URL = "https://rosatom.ru"
+# FSM: sqlite (по умолчанию), redis или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_DB = os.getenv("FSM_DB", "fsm.db")
+FSM_TTL = int(os.getenv("FSM_TTL", 24 * 60 * 60))
+FSM_PURGE_INTERVAL = int(os.getenv("FSM_PURGE_INTERVAL", 600))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+MEDIA_CACHE_PATH = os.getenv("MEDIA_CACHE_PATH", "media_cache.json")
+QR_FILE = "qrcode1.png"
+# Пауза между разбором ответа и следующим вопросом
+NEXT_QUESTION_DELAY = 1.5
+# Сколько при остановке ждать отправки уже запланированных сообщений
+DELAYED_DRAIN_TIMEOUT = 10
+# Компактный режим: разбор ответа и следующий вопрос в одном сообщении
+QUIZ_COMPACT = os.getenv("QUIZ_COMPACT", "0") == "1"
+# Readiness: период фоновых проб и пороги деградации
+READY_PROBE_INTERVAL = float(os.getenv("READY_PROBE_INTERVAL", 5))
+READY_MAX_LOOP_LAG = float(os.getenv("READY_MAX_LOOP_LAG", 0.5))
+READY_MAX_QUEUE_DEPTH = int(os.getenv("READY_MAX_QUEUE_DEPTH", 1000))
+READY_REQUIRE_SHEETS = os.getenv("READY_REQUIRE_SHEETS", "1") == "1"
+# Отвечать на нажатие кнопки (answerCallbackQuery) прямо в HTTP-ответе вебхука.
+# Сообщения так не уходят никогда: они идут через лимитер с повтором после 429.
+# Цена: HTTP-ответ ждет весь хендлер, включая паузы лимитера на чат и запись
+# журнала, и соединение Telegram занято все это время, поэтому прием апдейтов
+# ограничен примерно WEBHOOK_MAX_CONNECTIONS / время хендлера. По умолчанию
+# выключено: ответ на вебхук уходит сразу, хендлер работает в фоне
+WEBHOOK_INLINE_REPLY = os.getenv("WEBHOOK_INLINE_REPLY", "0") == "1"
+# По умолчанию Telegram открывает 40 соединений; 100 - максимум
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 100))
+# Long polling, если не задан RENDER_EXTERNAL_URL
+POLLING_ENABLED = os.getenv("POLLING_ENABLED", "1") == "1"
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 25))
+POLLING_BATCH = int(os.getenv("POLLING_BATCH", 100))
+# Сколько апдейтов обрабатывается одновременно и сколько может ждать своей очереди
+POLLING_CONCURRENCY = int(os.getenv("POLLING_CONCURRENCY", 32))
+POLLING_MAX_PENDING = int(os.getenv("POLLING_MAX_PENDING", 1000))
+POLLING_OFFSET_FILE = os.getenv("POLLING_OFFSET_FILE", "polling_offset.json")
+POLLING_RETRY_DELAY = 1
+POLLING_MAX_RETRY_DELAY = 30
+POLLING_DRAIN_TIMEOUT = 10
+# Несколько процессов: фронт на PORT раздает вебхуки воркерам на 127.0.0.1:WORKER_BASE_PORT+i
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", 9000))
+WORKER_HEALTH_INTERVAL = float(os.getenv("WORKER_HEALTH_INTERVAL", 10))
+WORKER_HEALTH_FAILURES = 3
+WORKER_RESTART_DELAY = 1
+WORKER_MAX_RESTART_DELAY = 30
+# Воркеру нужно время дописать журнал результатов в Sheets
+WORKER_STOP_TIMEOUT = 30
+# Лимиты Telegram: ~30 сообщений/с на бота и ~1 сообщение/с в один чат
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", 3))
+TG_RETRY_ATTEMPTS = int(os.getenv("TG_RETRY_ATTEMPTS", 3))
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", 16))
+# Вопросы и тексты: questions.json и texts.json в этом каталоге
+CONTENT_DIR = os.getenv("CONTENT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "content"))
+CONTENT_POLL_INTERVAL = float(os.getenv("CONTENT_POLL_INTERVAL", 5))
+# Сколько последних версий держать в памяти для начатых на них сессий
+CONTENT_KEEP_VERSIONS = int(os.getenv("CONTENT_KEEP_VERSIONS", 10))
+
+# ============== МЕТРИКИ ==============
+# Минимальные метрики в текстовом формате Prometheus, без внешних зависимостей.
+# Запись - словарь по кортежу меток и инкремент, чтобы не нагружать горячий путь
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = []
+
+def escape_label(value):
+    # Формат требует экранировать в значениях меток обратный слэш, кавычку и перевод строки
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}"
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._values = {}
+        METRICS.append(self)
+
+    def inc(self, *labels, value=1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    async def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def timed(self, *labels):
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(*labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    async def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = format_labels(self.labels + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+# Значение снимается функцией (обычной или async) в момент запроса /metrics
+class Gauge:
+    def __init__(self, name, doc, func):
+        self.name = name
+        self.doc = doc
+        self.func = func
+        METRICS.append(self)
+
+    async def render(self):
+        value = self.func()
+        if asyncio.iscoroutine(value):
+            value = await value
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+HANDLER_LATENCY = Histogram("quiz_handler_seconds", "Update handler latency", ("handler",))
+HANDLER_ERRORS = Counter("quiz_handler_errors_total", "Update handler exceptions", ("handler",))
+SHEETS_LATENCY = Histogram("quiz_sheets_call_seconds", "Google Sheets call latency", ("call",))
+SHEETS_ERRORS = Counter("quiz_sheets_errors_total", "Google Sheets call errors", ("call",))
+TELEGRAM_LATENCY = Histogram("quiz_telegram_request_seconds", "Outbound Telegram API latency", ("method",))
+TELEGRAM_ERRORS = Counter("quiz_telegram_errors_total", "Outbound Telegram API errors", ("method",))
+TELEGRAM_THROTTLED = Counter("quiz_telegram_429_total", "Telegram flood control responses", ("method",))
+FSM_LATENCY = Histogram("quiz_fsm_storage_seconds", "FSM storage operation latency", ("op",))
+
+async def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(await metric.render())
+    return "\n".join(lines) + "\n"
 
 # ============== IP-ФИЛЬТР ДЛЯ UPTIMEROBOT ==============
-async def ip_middleware(app, handler):
-    async def middleware_handler(request):
-        # Разрешенные IP-адреса UptimeRobot (Северная Америка)
-        allowed_ips = [
-            "34.210.0.0/17",
-            "35.155.0.0/16", 
-            "52.11.0.0/16",
-            "52.24.0.0/16",
-            "54.68.0.0/16",
-            "54.70.0.0/16",
-            "54.189.0.0/16",
-            "34.215.0.0/16",
-            "35.163.0.0/16",
-            "52.32.0.0/16",
-            "52.36.0.0/16",
-            "52.88.0.0/16",
-            "54.148.0.0/16",
-            "54.184.0.0/16",
-            "54.200.0.0/16",
-            "54.218.0.0/16"
-        ]
-        
-        client_ip = request.headers.get('X-Forwarded-For', request.remote)
-        
-        # Если это запрос к /ping - проверяем IP
-        if request.path == '/ping':
-            ip_allowed = False
+# Разрешенные IP-адреса UptimeRobot (Северная Америка); переопределяются через PING_ALLOWLIST
+DEFAULT_PING_ALLOWLIST = [
+    "34.210.0.0/17",
+    "35.155.0.0/16",
+    "52.11.0.0/16",
+    "52.24.0.0/16",
+    "54.68.0.0/16",
+    "54.70.0.0/16",
+    "54.189.0.0/16",
+    "34.215.0.0/16",
+    "35.163.0.0/16",
+    "52.32.0.0/16",
+    "52.36.0.0/16",
+    "52.88.0.0/16",
+    "54.148.0.0/16",
+    "54.184.0.0/16",
+    "54.200.0.0/16",
+    "54.218.0.0/16"
+]
+PING_ALLOWLIST = os.getenv("PING_ALLOWLIST")
+# /metrics и /ready: очереди и счетчики ошибок наружу не отдаем. По умолчанию -
+# loopback и частные сети (фронт, Prometheus и health check внутри платформы);
+# переопределяется через METRICS_ALLOWLIST
+DEFAULT_METRICS_ALLOWLIST = [
+    "127.0.0.0/8",
+    "10.0.0.0/8",
+    "172.16.0.0/12",
+    "192.168.0.0/16",
+    "::1/128",
+    "fc00::/7",
+]
+METRICS_ALLOWLIST = os.getenv("METRICS_ALLOWLIST")
+# Сколько прокси перед приложением дописывают адрес в X-Forwarded-For (на Render - один)
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 1))
+
+# Сети разбираются один раз: пересекающиеся диапазоны склеиваются в отсортированную
+# таблицу целочисленных интервалов, проверка адреса - один bisect
+class IpAllowlist:
+    def __init__(self, networks):
+        ranges = {4: [], 6: []}
+        for network in networks:
+            network = network.strip()
+            # Пустые элементы (лишняя запятая) пропускаем, битые - логируем и тоже
+            # пропускаем: ошибка в списке не должна ронять бота при импорте
+            if not network:
+                continue
             try:
-                for ip_range in allowed_ips:
-                    if ipaddress.ip_address(client_ip) in ipaddress.ip_network(ip_range):
-                        ip_allowed = True
-                        break
-            except Exception as e:
-                logging.warning(f"⚠️ IP check error for {client_ip}: {e}")
-                ip_allowed = True  # В случае ошибки разрешаем доступ
+                net = ipaddress.ip_network(network, strict=False)
+            except ValueError as e:
+                logging.error(f"❌ Ignoring invalid IP allowlist entry {network!r}: {e}")
+                continue
+            ranges[net.version].append((int(net.network_address), int(net.broadcast_address)))
+        self._tables = {}
+        for version, items in ranges.items():
+            starts, ends = [], []
+            for start, end in sorted(items):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._tables[version] = (starts, ends)
+
+    @classmethod
+    def from_config(cls, value, default):
+        return cls(value.split(",") if value else default)
+
+    def __contains__(self, address):
+        ip = ipaddress.ip_address(address)
+        starts, ends = self._tables[ip.version]
+        value = int(ip)
+        i = bisect.bisect_right(starts, value) - 1
+        return i >= 0 and value <= ends[i]
+
+def client_ip(request, trusted_hops=TRUSTED_PROXY_HOPS):
+    # Левые элементы цепочки клиент может подделать, поэтому берем адрес,
+    # дописанный последним доверенным прокси
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded and trusted_hops:
+        chain = [part.strip() for part in forwarded.split(",") if part.strip()]
+        if chain:
+            return chain[-min(trusted_hops, len(chain))]
+    return request.remote
+
+ping_allowlist = IpAllowlist.from_config(PING_ALLOWLIST, DEFAULT_PING_ALLOWLIST)
+metrics_allowlist = IpAllowlist.from_config(METRICS_ALLOWLIST, DEFAULT_METRICS_ALLOWLIST)
+
+# Проверка IP навешивается только на те маршруты, которым она нужна,
+# а не глобальным middleware на каждый запрос (включая /webhook)
+def ip_guard(allowlist):
+    def decorator(handler):
+        async def guarded_handler(request):
+            ip = client_ip(request)
+            try:
+                ip_allowed = ip in allowlist
+            except ValueError as e:
+                logging.warning(f"⚠️ IP check error for {ip}: {e}")
+                ip_allowed = False
             
             if not ip_allowed:
-                logging.warning(f"⛔ Blocked ping from unauthorized IP: {client_ip}")
+                logging.warning(f"⛔ Blocked {request.path} from unauthorized IP: {ip}")
                 return web.Response(text="Unauthorized", status=403)
+            
+            return await handler(request)
         
-        return await handler(request)
+        return guarded_handler
     
-    return middleware_handler
+    return decorator
 
 # ============== GOOGLE SHEETS КОНФИГУРАЦИЯ ==============
-def get_sheet():
-    try:
+GOOGLE_CREDS_PATH = "/etc/secrets/google-credentials.json"
+# ПРАВИЛЬНЫЙ ID ТАБЛИЦЫ
+SHEET_ID = "1Nc3nDzPyie0qgOwHRn4QuHeGBRhXA5L5sJ4SGqaFFJ8"
+SHEET_HEADER = ["User ID", "Name", "Email", "Language", "Category", "Difficulty", "Score", "Timestamp"]
+SHEETS_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+SHEETS_WORKERS = int(os.getenv("SHEETS_WORKERS", 4))
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", 10))
+SHEETS_TOKEN_REFRESH_INTERVAL = int(os.getenv("SHEETS_TOKEN_REFRESH_INTERVAL", 300))
+# Токен обновляем заранее, если до истечения осталось меньше этого запаса
+SHEETS_TOKEN_REFRESH_MARGIN = timedelta(minutes=10)
+PARTICIPANTS_SYNC_INTERVAL = int(os.getenv("PARTICIPANTS_SYNC_INTERVAL", 60))
+# background - порт открывается сразу, Sheets проверяются фоновой задачей;
+# blocking - как раньше, без доступа к Sheets бот не стартует
+STARTUP_SHEETS_CHECK = os.getenv("STARTUP_SHEETS_CHECK", "background")
+RESULTS_DB = os.getenv("RESULTS_DB", "results.db")
+RESULTS_BATCH_SIZE = int(os.getenv("RESULTS_BATCH_SIZE", 50))
+RESULTS_FLUSH_INTERVAL = float(os.getenv("RESULTS_FLUSH_INTERVAL", 2))
+RESULTS_RETRY_DELAY = 1
+RESULTS_MAX_RETRY_DELAY = 60
+
+# Долгоживущий клиент: авторизуемся один раз, держим одну HTTP-сессию
+# и закэшированный лист, заголовок проверяем только при первом подключении
+class SheetsClient:
+    def __init__(self, creds_path, sheet_id):
+        self.creds_path = creds_path
+        self.sheet_id = sheet_id
+        self._creds = None
+        self._client = None
+        self._sheet = None
+        self._lock = threading.Lock()
+
+    def worksheet(self):
+        sheet = self._sheet
+        if sheet is None:
+            with self._lock:
+                if self._sheet is None:
+                    self._connect()
+                sheet = self._sheet
+        return sheet
+
+    def _connect(self):
         # Читаем credentials из Secret Files
-        creds_path = "/etc/secrets/google-credentials.json"
-        if not os.path.exists(creds_path):
+        if not os.path.exists(self.creds_path):
             logging.error("❌ Google credentials file not found in /etc/secrets/")
             raise FileNotFoundError("Google credentials file not found")
-        
-        logging.info(f"✅ Using credentials from: {creds_path}")
-        creds = Credentials.from_service_account_file(
-            creds_path,
-            scopes=["https://www.googleapis.com/auth/spreadsheets"]
-        )
+
+        import gspread
+        from google.oauth2.service_account import Credentials
+
+        logging.info(f"✅ Using credentials from: {self.creds_path}")
+        creds = Credentials.from_service_account_file(self.creds_path, scopes=SHEETS_SCOPES)
         client = gspread.authorize(creds)
-        
-        # ПРАВИЛЬНЫЙ ID ТАБЛИЦЫ
-        SHEET_ID = "1Nc3nDzPyie0qgOwHRn4QuHeGBRhXA5L5sJ4SGqaFFJ8"
-        sheet = client.open_by_key(SHEET_ID).sheet1
-        
+        client.set_timeout(SHEETS_TIMEOUT)
+        sheet = client.open_by_key(self.sheet_id).sheet1
+
         # Создаем заголовки если лист пустой
-        if not sheet.get_all_records():
-            sheet.append_row(["User ID", "Name", "Email", "Language", "Category", "Difficulty", "Score", "Timestamp"])
-        
+        if not sheet.row_values(1):
+            sheet.append_row(SHEET_HEADER)
+
+        self._creds = creds
+        self._client = client
+        self._sheet = sheet
         logging.info("✅ Google Sheets connection successful")
-        return sheet
-        
+
+    def refresh_token(self):
+        with self._lock:
+            if self._client is None:
+                return
+            creds = self._creds
+            # google-auth хранит expiry как наивное UTC-время
+            expiry = creds.expiry and creds.expiry.replace(tzinfo=timezone.utc)
+            if creds.valid and expiry and expiry - datetime.now(timezone.utc) > SHEETS_TOKEN_REFRESH_MARGIN:
+                return
+            # login() обновляет токен через ту же сессию и прописывает его в заголовки
+            self._client.http_client.login()
+            logging.info("🔑 Google Sheets token refreshed")
+
+sheets = SheetsClient(GOOGLE_CREDS_PATH, SHEET_ID)
+# gspread синхронный, поэтому все обращения к Sheets идут через отдельный
+# ограниченный пул потоков, чтобы не блокировать event loop
+# Итог последнего обращения к Sheets - по нему readiness судит о доступности
+# без отдельных запросов (участники синхронизируются минимум раз в минуту)
+sheets_status = {"ok": None, "at": None, "error": None}
+sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix="sheets")
+
+async def run_sheets(func, *args, timeout=SHEETS_TIMEOUT):
+    loop = asyncio.get_running_loop()
+    call = func.__name__
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(loop.run_in_executor(sheets_executor, func, *args), timeout)
+    except Exception as e:
+        SHEETS_ERRORS.inc(call)
+        sheets_status.update(ok=False, at=time.time(), error=repr(e))
+        raise
+    else:
+        sheets_status.update(ok=True, at=time.time(), error=None)
+        return result
+    finally:
+        SHEETS_LATENCY.observe(time.perf_counter() - start, call)
+
+# Локальный индекс ID участников: колонку A читаем один раз, дальше дочитываем
+# только новые строки, а свои записи добавляем сразу после append
+class ParticipantIndex:
+    def __init__(self):
+        self.loaded = False
+        self._ids = set()
+        self._rows = 0  # сколько строк листа уже прочитано, включая заголовок
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id):
+        return str(user_id) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, user_id):
+        self._ids.add(str(user_id))
+
+    def sync(self, sheet):
+        with self._lock:
+            start = self._rows + 1
+            values = sheet.get(f"A{start}:A")
+            new_ids = {row[0] for row in values if row}
+            if start == 1:
+                new_ids.discard(SHEET_HEADER[0])
+            self._ids.update(new_ids)
+            self._rows += len(values)
+            self.loaded = True
+            return len(new_ids)
+
+participants = ParticipantIndex()
+
+def get_sheet():
+    try:
+        return sheets.worksheet()
     except Exception as e:
         logging.error(f"❌ Google Sheets error: {e}")
         raise
 
-def append_result(user_id, name, email, language, category, difficulty, score):
+async def sheets_token_refresher():
+    while True:
+        await asyncio.sleep(SHEETS_TOKEN_REFRESH_INTERVAL)
+        try:
+            await run_sheets(sheets.refresh_token)
+        except Exception as e:
+            logging.warning(f"⚠️ Google Sheets token refresh failed: {e}")
+
+def sync_participants():
+    return participants.sync(get_sheet())
+
+# Первая проверка Sheets после открытия порта; при неудаче индекс
+# догрузит participants_syncer, а до тех пор /start проверяет лист напрямую
+async def sheets_warmup():
+    start = time.perf_counter()
     try:
-        sheet = get_sheet()
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        sheet.append_row([str(user_id), name, email, language, category, difficulty, str(score), timestamp])
-        logging.info(f"✅ Result saved: {name}, category: {category}, score: {score}")
-        return True
+        # Подключение - это несколько запросов, у каждого свой таймаут gspread
+        await run_sheets(sync_participants, timeout=None)
+    except Exception as e:
+        logging.error(f"❌ Google Sheets connection failed: {e}")
+        return
+    logging.info(
+        f"✅ Google Sheets ready in {time.perf_counter() - start:.2f}s "
+        f"({startup_timer.elapsed():.2f}s after start), {len(participants)} participants"
+    )
+
+def is_quota_error(e):
+    # gspread грузится лениво: пока его нет в sys.modules, APIError возникнуть не мог
+    exceptions = sys.modules.get("gspread.exceptions")
+    return exceptions is not None and isinstance(e, exceptions.APIError) and e.response.status_code == 429
+
+async def participants_syncer():
+    while True:
+        await asyncio.sleep(PARTICIPANTS_SYNC_INTERVAL)
+        try:
+            added = await run_sheets(sync_participants)
+            if added:
+                logging.info(f"👥 Participant index synced: +{added}, total {len(participants)}")
+        except Exception as e:
+            logging.warning(f"⚠️ Participant index sync failed: {e}")
+
+def write_results(rows):
+    sheet = get_sheet()
+    sheet.append_rows(rows)
+    for row in rows:
+        participants.add(row[0])
+
+# Локальный журнал результатов (SQLite). Каждый результат сначала фиксируется
+# здесь, а фоновый репликатор переносит неотправленные строки в Sheets.
+# Коммиты группируются: все append, пришедшие за одну итерацию, пишутся
+# одной транзакцией с одним fsync.
+class ResultJournal:
+    def __init__(self, path, batch_size, flush_interval):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending_count = 0
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+        self._queue = []
+        self._committer = None
+        self._wakeup = asyncio.Event()
+        self._replicate_lock = asyncio.Lock()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=FULL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, row TEXT NOT NULL, sent INTEGER NOT NULL DEFAULT 0)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS results_pending ON results (sent, id)")
+        db.commit()
+        self._db = db
+        for (row,) in db.execute("SELECT row FROM results"):
+            participants.add(json.loads(row)[0])
+        self.pending_count = db.execute("SELECT COUNT(*) FROM results WHERE sent = 0").fetchone()[0]
+
+    async def open(self):
+        await self._run(self._open)
+        if self.pending_count:
+            logging.info(f"📒 Replaying {self.pending_count} unsent results from journal")
+            self._wakeup.set()
+
+    def _insert(self, rows):
+        self._db.executemany(
+            "INSERT INTO results (row) VALUES (?)",
+            [(json.dumps(row, ensure_ascii=False),) for row in rows],
+        )
+        self._db.commit()
+
+    async def append(self, row):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((row, future))
+        if self._committer is None or self._committer.done():
+            self._committer = asyncio.create_task(self._commit())
+        return await future
+
+    async def _commit(self):
+        while self._queue:
+            batch, self._queue = self._queue, []
+            try:
+                await self._run(self._insert, [row for row, _ in batch])
+            except Exception as e:
+                logging.error(f"❌ Failed to write {len(batch)} results to journal: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.pending_count += len(batch)
+            for _, future in batch:
+                future.set_result(True)
+            if self.pending_count >= self.batch_size:
+                self._wakeup.set()
+
+    def _fetch_pending(self):
+        return self._db.execute(
+            "SELECT id, row FROM results WHERE sent = 0 ORDER BY id LIMIT ?", (self.batch_size,)
+        ).fetchall()
+
+    def _mark_sent(self, ids):
+        self._db.executemany("UPDATE results SET sent = 1 WHERE id = ?", [(i,) for i in ids])
+        self._db.commit()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.replicate()
+
+    async def replicate(self, attempts=None):
+        async with self._replicate_lock:
+            delay = RESULTS_RETRY_DELAY
+            failures = 0
+            while True:
+                pending = await self._run(self._fetch_pending)
+                if not pending:
+                    return True
+                rows = [json.loads(row) for _, row in pending]
+                try:
+                    # append_rows не идемпотентен: таймаут asyncio не остановит поток,
+                    # и запись, "не успевшая" здесь, все равно попадет в лист, а на
+                    # следующей итерации ушла бы второй раз. Ограничивает запись
+                    # только таймаут запросов gspread (SHEETS_TIMEOUT)
+                    await run_sheets(write_results, rows, timeout=None)
+                except Exception as e:
+                    failures += 1
+                    if attempts is not None and failures >= attempts:
+                        logging.error(f"❌ Results left in journal after {failures} attempts: {e}")
+                        return False
+                    if is_quota_error(e):
+                        logging.warning(f"⚠️ Sheets quota exceeded, retrying in {delay}s")
+                    else:
+                        logging.error(f"❌ Failed to send {len(rows)} results, retrying in {delay}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RESULTS_MAX_RETRY_DELAY)
+                    continue
+                await self._run(self._mark_sent, [i for i, _ in pending])
+                self.pending_count = max(self.pending_count - len(pending), 0)
+                delay = RESULTS_RETRY_DELAY
+                logging.info(f"✅ Sent {len(rows)} results to Google Sheets")
+
+    async def close(self):
+        if self._committer is not None:
+            await self._committer
+        if self._db is not None:
+            await self._run(self._db.close)
+        self._executor.shutdown(wait=True)
+
+results_journal = ResultJournal(RESULTS_DB, RESULTS_BATCH_SIZE, RESULTS_FLUSH_INTERVAL)
+
+async def append_result(user_id, name, email, language, category, difficulty, score):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    row = [str(user_id), name, email, language, category, difficulty, str(score), timestamp]
+    try:
+        await results_journal.append(row)
     except Exception as e:
         logging.error(f"❌ Failed to save result: {e}")
         return False
+    participants.add(user_id)
+    logging.info(f"✅ Result saved: {name}, category: {category}, score: {score}")
+    return True
 
 def user_exists(user_id):
+    # Ошибки не глотаем: run_sheets должен увидеть их и отметить Sheets недоступным
+    if not participants.loaded:
+        participants.sync(get_sheet())
+    return user_id in participants
+
+async def user_exists_async(user_id):
+    # После первой загрузки индекса проверка не ходит в сеть
+    if participants.loaded:
+        return user_id in participants
     try:
-        sheet = get_sheet()
-        ids = sheet.col_values(1)
-        return str(user_id) in ids
+        return await run_sheets(user_exists, user_id)
+    except asyncio.TimeoutError:
+        logging.error(f"❌ User existence check timed out after {SHEETS_TIMEOUT}s")
+        return False
     except Exception as e:
         logging.error(f"❌ Error checking user existence: {e}")
         return False
 
-# ============== ВОПРОСЫ ==============
-QUESTIONS = {
-    "ru": {
-        "Экологическое просвещение": {
-            "Полегче": [
-                {"text": "Что такое экосистема?", "options": [
-                    "Часть бизнес-стратегии", 
-                    "Совокупность совместно обитающих организмов и условий их существования, находящихся в закономерной взаимосвязи друг с другом", 
-                    "Группа людей, которые занимаются охраной окружающей среды", 
-                    "Система, основанная на учете потребностей природы"
-                ], "correct_option_index": 1, "explanation": "Экосистема - это буквально всё, что нас окружает. Мы, люди, так же являемся частью местной экосистемы, поскольку находимся во взаимодействии с другими живыми организмами и природой."},
-                
-                {"text": "Невозобновляемые ресурсы - это ресурсы, которые...", "options": [
-                    "Восполняются самостоятельно в течение короткого периода времени", 
-                    "Которые получаются путем переработки отходов и их использования в промышленности", 
-                    "Невозможно восстановить без определенных технологий", 
-                    "Которые исчерпываются в результате их длительной добычи и использования"
-                ], "correct_option_index": 3, "explanation": "Невозобновляемые ресурсы планеты имеют конечный запас. Яркий пример - ископаемое топливо (нефть, уголь, газ), применяемое в энергетике. Подбирая альтернативные источники выработки энергии, мы уменьшаем негативное воздействие на окружающую среду."},
-                
-                {"text": "Сколько экопривычек следует применять среднестатистическому горожанину?", "options": [
-                    "от 10 до 15", 
-                    "Всё индивидуально", 
-                    "от 30 до 40", 
-                    "от 20 до 30"
-                ], "correct_option_index": 1, "explanation": "Есть много примеров, как сделать свою жизнь экологичнее, но это не означает, что существуют стандарты, сколько у каждого должно быть привычек. Для того чтобы закрепить экологичный паттерн поведения и встроить в жизнь, важно подбирать привычки исходя из образа жизни."},
-                
-                {"text": "Что собой подразумевает день экологического долга?", "options": [
-                    "День, когда все жители планеты останавливают использование любых природных ресурсов",
-                    "День, когда наступает глобальный кризис в экологии и человечество сталкивается с необратимыми последствиями",
-                    "Международный день обращения внимания на потребность в экологически устойчивом поведении и уменьшении углеродного следа",
-                    "День в году, когда человечество исчерпывает ресурсы, способные восстановиться за один год, и начинает использовать ресурсы будущих поколений"
-                ], "correct_option_index": 3, "explanation": "Да, оказывается, мы можем жить в долг у ресурсов планеты! Дата рассчитывается независимым аналитическом центром Global Footprint Network по средним показателям всех стран."},
-                
-                {"text": "Почему бумажные стаканчики не промокают?", "options": [
-                    "Из-за двойного бумажного слоя", 
-                    "Из-за слоя полиэтилена", 
-                    "Из-за слоя поливинилхлорида"
-                ], "correct_option_index": 1, "explanation": "К счастью, поливинилхлорид (ПВХ) тут не при чем, зато тонкий слой полиэтилена является тем самым защитным слоем, который препятствует размоканию бумажных стаканов! Однако, именно он и препятствует их переработке."},
-                
-                {"text": "Если бы мы отдельно сортировали этот вид отходов, у нас было бы меньше проблем с переработкой, а также уменьшилось бы выделение метана в атмосферу", "options": [
-                    "Пластик", 
-                    "Бумага", 
-                    "Металл", 
-                    "Пищевые отходы"
-                ], "correct_option_index": 3, "explanation": "Из-за пищевых отходов больше сложностей, чем может показаться! Они могут препятствовать переработке вторичного сырья из-за загрязнения, а на свалках в процессе разложения являются причиной выделения метана в атмосферу."}
-            ],
-            "Посложнее": [
-                {"text": "Какой объём космических отходов сейчас на орбитах?", "options": [
-                    "До 30 тысяч единиц", 
-                    "До 1млн единиц", 
-                    "До 15млн единиц", 
-                    "До 130млн единиц"
-                ], "correct_option_index": 3, "explanation": "Невероятно, но факт. По средним оценкам, на данный момент на различных орбитах находится 120-130млн обломков малых и средних размеров."},
-                
-                {"text": "Какой невозобновляемый природный ресурс является одним из самых добываемых в мире?", "options": [
-                    "Золото", 
-                    "Железная руда", 
-                    "Песок", 
-                    "Уголь"
-                ], "correct_option_index": 2, "explanation": "Помимо того, что песок является одним из самых распространенных природных ресурсов на Земле и используется во многих отраслях, его ресурсы начинают заканчиваться!"},
-                
-                {"text": "Что является главным производителем кислорода?", "options": [
-                    "Деревья", 
-                    "Небольшие растения", 
-                    "Воздух", 
-                    "Фитопланктон"
-                ], "correct_option_index": 3, "explanation": "Именно эти морские микроорганизмы являются производителем от 40 до 60% кислорода на Земле! Конечно, все земные растения тоже вырабатывают кислород, но в меньших масштабах."},
-                
-                {"text": "Что такое экономика замкнутого цикла?", "options": [
-                    "Экономика, где цепочка «добыча ресурсов — производство — потребление — утилизация» замкнута в непрерывный возобновляемый цикл",
-                    "Модель, в которой доходы и расходы организаций взаимно связаны между собой",
-                    "Вид экономической системы, характеризующийся периодическими колебаниями национального производства, доходов и занятости",
-                    "Модель, при которой не происходит никаких колебаний национального производства и занятости, а все системы работают стабильно без изменений"
-                ], "correct_option_index": 0, "explanation": "Её ещё называют 'экономикой будущего', поскольку она является альтернативой линейной экономике, при которой жизненный цикл товара не учитывает его вторичное использование."},
-                
-                {"text": "На этот вид отходов приходится до 10% мирового выброса углекислого газа - больше, чем все международные рейсы и перевозки вместе взятые", "options": [
-                    "Бытовые отходы", 
-                    "Отходы ресторанной деятельности", 
-                    "Отходы производства автомобилей", 
-                    "Отходы производства одежды"
-                ], "correct_option_index": 3, "explanation": "Именно такую цифру предоставила Программа ООН по окружающей среде, в рамках которой учитывается не только одежда в виде бытового отхода, но и весь цикл производства."},
-                
-                {"text": "Это явление в океане иногда называют 'новым континентом', однако оно не имеет точных границ и существенно вредит морской экосистеме. Что это?", "options": [
-                    "Размножение фитопланктонов", 
-                    "Место с захоронением кораблей, вышедших из строя", 
-                    "Большое тихоокеанское мусорное пятно", 
-                    "Старые нефтяные платформы"
-                ], "correct_option_index": 2, "explanation": "Название - серьёзное, ситуация - неприятная. Это централизованное скопление мусора с различных континентов в верхних слоях Тихого океана."}
-            ]
-        },
-        "Природа России": {
-            "Полегче": [
-                {"text": "Как называется самая длинная река России?", "options": [
-                    "Волга", 
-                    "Лена", 
-                    "Обь", 
-                    "Амур"
-                ], "correct_option_index": 1, "explanation": "Лена — крупнейшая из рек, чей бассейн полностью лежит в пределах России. Её длина составляет около 4400км, протекая через всю Иркутскую область и Якутию."},
-                
-                {"text": "Какая глубина у озера Байкал?", "options": [
-                    "1100 метров", 
-                    "2050 метров", 
-                    "898 метров", 
-                    "1642 метра"
-                ], "correct_option_index": 3, "explanation": "Помимо того, что озеро Байкал является самым глубоким озером в мире, это также и крупнейшее пресноводное озеро, в котором сосредоточено до 19% мирового запаса пресной воды."},
-                
-                {"text": "Как называется самая высокая горная вершина России?", "options": [
-                    "Эльбрус", 
-                    "Белуха", 
-                    "Пик Шота Руставели", 
-                    "Казбек"
-                ], "correct_option_index": 0, "explanation": "Эльбрус является самой высокой точкой России с двумя вершинами-пятетысячниками: 5642 и 5621м."},
-                
-                {"text": "Сколько субъектов насчитывает Российская Федерация?", "options": [
-                    "64", 
-                    "89", 
-                    "80", 
-                    "91"
-                ], "correct_option_index": 1, "explanation": "Российская Федерация состоит из 89 субъектов."},
-                
-                {"text": "Как называется крупнейший город за полярным кругом?", "options": [
-                    "Апатиты", 
-                    "Мурманск", 
-                    "Североморск", 
-                    "Тромсё"
-                ], "correct_option_index": 1, "explanation": "Мурманск считается самым крупным городом в мире за полярным кругом с численностью населения в 267 тысяч человек."},
-                
-                {"text": "Что такое золотое кольцо России?", "options": [
-                    "Туристический маршрут, проходящий через несколько исторических городов Золотого кольца Центральной России",
-                    "Термин, используемый для обозначения круговой системы дорог, соединяющих города-миллионники России",
-                    "Ежегодный фестиваль ремесленников, проходящий на территории Ярославской области",
-                    "Название российского футбольного турнира, который проводится среди сильнейших команд из разных регионов страны"
-                ], "correct_option_index": 0, "explanation": "Золотое кольцо России — туристический маршрут, проходящий по древним городам-центрам народных ремёсел."}
-            ],
-            "Посложнее": [
-                {"text": "Какой город России считается самым холодным?", "options": [
-                    "Мурманск", 
-                    "Верхоянск", 
-                    "Норильск", 
-                    "Воркута"
-                ], "correct_option_index": 1, "explanation": "В 1982 году гидрометеостанция в Верхоянске зафиксировала абсолютный температурный минимум — 67,8 градуса ниже нуля."},
-                
-                {"text": "В какой части России расположено наибольшее число геотермальных электростанций?", "options": [
-                    "Алтайский край", 
-                    "Камчатский край", 
-                    "Краснодарский край", 
-                    "Дагестан"
-                ], "correct_option_index": 1, "explanation": "Геотермальная энергетика - перспективное направление. Камчатский край славится Долиной Гейзеров."},
-                
-                {"text": "Как называется самый северный природный заповедник России, известный как 'дом белых медведей'?", "options": [
-                    "Остров Врангеля", 
-                    "Кузнецкий Алатау", 
-                    "Кивач", 
-                    "Тебердинский заповедник"
-                ], "correct_option_index": 0, "explanation": "Заповедник 'Остров Врангеля' расположен в районе Чукотского моря и является ключевым местом обитания белого медведя."},
-                
-                {"text": "Многие называют этот парк 'птичьим мостом', так как он является частью миграционного пути десятка миллионов птиц ежегодно.", "options": [
-                    "Остров Врангеля", 
-                    "Куршская коса", 
-                    "Берег Азовского моря", 
-                    "Григорьевская коса"
-                ], "correct_option_index": 1, "explanation": "Местные называют Куршскую косу 'птичьим мостом' не просто так - в пик миграции на её территории фиксируется от 1.5 до 2млн особей в день."},
-                
-                {"text": "Семь великанов, мансийские болваны и священная гора. О чём идет речь?", "options": [
-                    "Маньпупунёр", 
-                    "Стоунхендж", 
-                    "Плато Бермамыт", 
-                    "Плато Путорана"
-                ], "correct_option_index": 0, "explanation": "Уникальные по своей природе столбы выветривания Манпупунёр на Северном Урале ежегодно привлекают внимание десятков тысяч туристов."},
-                
-                {"text": "Каким был первый российский природный объект, включенный в список объектов Всемирного природного наследия ЮНЕСКО?", "options": [
-                    "Куршская коса", 
-                    "Золотые горы Алтая", 
-                    "Озеро Байкал", 
-                    "Девственные леса Коми"
-                ], "correct_option_index": 3, "explanation": "Девственные леса Коми - нетронутые леса, простирающиеся на территории 32 600 км²."}
-            ]
-        },
-        "Атомная промышленность": {
-            "Полегче": [
-                {"text": "Этот город – база атомного ледокольного флота России", "options": [
-                    "Мурманск", 
-                    "Санкт-Петербург", 
-                    "Владивосток", 
-                    "Архангельск"
-                ], "correct_option_index": 0, "explanation": "Мурманск является базой атомного ледокольного флота России."},
-                
-                {"text": "Из соображений секретности здание первой в мире Обнинской АЭС построили похожим на…", "options": [
-                    "Цирк", 
-                    "Библиотеку", 
-                    "Кафе", 
-                    "Жилой дом"
-                ], "correct_option_index": 3, "explanation": "Первая в мире АЭС в Обнинске была построена похожей на жилой дом из соображений секретности."},
-                
-                {"text": "Правда или миф? На Земле скоро иссякнет запас урана", "options": [
-                    "Правда", 
-                    "Миф"
-                ], "correct_option_index": 1, "explanation": "Это миф! Урана на нашей планете в 600 раз больше, чем золота. Эксперты считают, что его хватит еще на пятьсот лет."},
-                
-                {"text": "Какое количество выбросов CO2 предотвращает работа российских АЭС, построенных в мире в настоящий момент?", "options": [
-                    "20 млн тонн", 
-                    "95 млн тонн", 
-                    "145 млн тонн", 
-                    "217 млн тонн"
-                ], "correct_option_index": 3, "explanation": "Российские АЭС предотвращают выброс 217 млн тонн CO2."},
-                
-                {"text": "Где построена первая в мире АЭС?", "options": [
-                    "Россия", 
-                    "Япония", 
-                    "Франция"
-                ], "correct_option_index": 0, "explanation": "В мае 1950 года в Обнинске (Калужская область) началось строительство первой в мире АЭС."},
-                
-                {"text": "Правда или миф? Вся радиация — вредная", "options": [
-                    "Правда", 
-                    "Миф"
-                ], "correct_option_index": 1, "explanation": "А вот и нет! На самом деле человека всегда окружает радиационный фон. Но не вся радиация опасна, вопрос в дозах излучения."}
-            ],
-            "Посложнее": [
-                {"text": "По каким морям проходит Северный морской путь?", "options": [
-                    "Карское море, море Лаптевых, Восточно-Сибирское море, Чукотское море, Берингово море",
-                    "Море Бофорта, море Линкольна, Гренландское море",
-                    "Баренцево море, Белое море, Охотское море",
-                    "Балтийское море, Черное море, Каспийское море"
-                ], "correct_option_index": 0, "explanation": "Северный морской путь проходит по Карскому морю, морю Лаптевых, Восточно-Сибирскому морю, Чукотскому морю и Берингову морю."},
-                
-                {"text": "Это первая в мире атомная электростанция, расположенная в зоне вечной мерзлоты", "options": [
-                    "Белоярская АЭС", 
-                    "Балтийская АЭС", 
-                    "Балаковская АЭС", 
-                    "Билибинская АЭС"
-                ], "correct_option_index": 3, "explanation": "Билибинская АЭС - первая в мире атомная электростанция, расположенная в зоне вечной мерзлоты."},
-                
-                {"text": "Выберите, какими крупными проектами в сфере ликвидации накопленного вреда занимается Росатом?", "options": [
-                    "Городская свалка в Челябинске, Промышленная площадка в г. Усолье-Сибирское, ОАО «Байкальский целлюлозно-бумажный комбинат», Полигон 'Красный бор'",
-                    "Мусорный полигон 'Ядрово', Промышленная площадка в г. Кемерово",
-                    "Все перечисленные варианты",
-                    "Ни один из перечисленных вариантов"
-                ], "correct_option_index": 0, "explanation": "Росатом занимается ликвидацией накопленного вреда на объектах: Городская свалка в Челябинске, Промышленная площадка в г. Усолье-Сибирское, ОАО «Байкальский целлюлозно-бумажный комбинат», Полигон 'Красный бор'."},
-                
-                {"text": "Какой элемент лишний? Выберите один вариант:", "options": [
-                    "Индий", 
-                    "Уран", 
-                    "Литий", 
-                    "Радий", 
-                    "Барий"
-                ], "correct_option_index": 2, "explanation": "Лишний элемент — литий, он единственный в этой компании не радиоактивный."},
-                
-                {"text": "Правда или миф? Рядом с АЭС опасно возводить жилые дома.", "options": [
-                    "Правда", 
-                    "Миф"
-                ], "correct_option_index": 1, "explanation": "Мы живем при постоянном радиационном фоне. Возле АЭС жить не опасно, уже на расстоянии 80 км человек получает дозу облучения 0,01 миллизиверта в год."},
-                
-                {"text": "В состав Росатома входит единственная в мире плавучая атомная станция. Чем она занимается?", "options": [
-                    "Снабжает электроэнергией порт Певек на Чукотке",
-                    "Служит перевалочным пунктом для кораблей Атомфлота",
-                    "Используется для продажи электроэнергии другим странам",
-                    "Служит плавучей стоянкой для ледоколов"
-                ], "correct_option_index": 0, "explanation": "Единственную в мире плавучую атомную станцию «Академик Ломоносов» снабжает электроэнергией Чукотский автономный округ, в первую очередь город Певек."}
-            ]
-        }
-    },
-    "en": {
-        "Environmental Education": {
-            "Easy": [
-                {"text": "What is an ecosystem?", "options": [
-                    "Part of a business strategy",
-                    "A set of cohabiting organisms and their living conditions that are in a natural relationship with each other",
-                    "A group of people engaged in environmental protection",
-                    "A system based on accounting for the needs of nature"
-                ], "correct_option_index": 1, "explanation": "An ecosystem is literally everything that surrounds us. We humans are also part of the local ecosystem as we interact with other living organisms and nature."},
-                
-                {"text": "Non-renewable resources are resources that...", "options": [
-                    "Replenish themselves within a short period of time",
-                    "Are obtained by recycling waste and using it in industry",
-                    "Cannot be restored without certain technologies",
-                    "Are depleted as a result of their long-term extraction and use"
-                ], "correct_option_index": 3, "explanation": "The planet's non-renewable resources have a finite supply. A prime example is fossil fuels (oil, coal, gas) used in energy."},
-                
-                {"text": "How many eco-habits should an average city dweller apply?", "options": [
-                    "from 10 to 15",
-                    "Everything is individual",
-                    "from 30 to 40",
-                    "from 20 to 30"
-                ], "correct_option_index": 1, "explanation": "There are many examples of how to make your life more eco-friendly, but this does not mean that there are standards for how many habits each person should have."},
-                
-                {"text": "What does Ecological Debt Day imply?", "options": [
-                    "The day when all inhabitants of the planet stop using any natural resources",
-                    "The day when a global ecological crisis occurs and humanity faces irreversible consequences",
-                    "International day to draw attention to the need for environmentally sustainable behavior and reducing carbon footprint",
-                    "The day of the year when humanity exhausts the resources capable of recovering in one year and begins to use the resources of future generations"
-                ], "correct_option_index": 3, "explanation": "Yes, it turns out we can live on credit from the planet's resources! The date is calculated by the independent analytical center Global Footprint Network."},
-                
-                {"text": "Why don't paper cups get wet?", "options": [
-                    "Due to the double paper layer",
-                    "Due to the polyethylene layer",
-                    "Due to the polyvinyl chloride layer"
-                ], "correct_option_index": 1, "explanation": "Fortunately, polyvinyl chloride (PVC) has nothing to do with it, but a thin layer of polyethylene is the very protective layer that prevents paper cups from getting wet!"},
-                
-                {"text": "If we separately sorted this type of waste, we would have fewer problems with recycling, and methane emissions into the atmosphere would also decrease", "options": [
-                    "Plastic",
-                    "Paper",
-                    "Metal",
-                    "Food waste"
-                ], "correct_option_index": 3, "explanation": "Food waste causes more difficulties than it might seem! They can interfere with the recycling of secondary raw materials due to contamination."}
-            ],
-            "Difficult": [
-                {"text": "What volume of space debris is currently in orbit?", "options": [
-                    "Up to 30 thousand units",
-                    "Up to 1 million units",
-                    "Up to 15 million units",
-                    "Up to 130 million units"
-                ], "correct_option_index": 3, "explanation": "Incredible but true. According to average estimates, there are currently 120-130 million small and medium-sized debris in various orbits."},
-                
-                {"text": "Which non-renewable natural resource is one of the most mined in the world?", "options": [
-                    "Gold",
-                    "Iron ore",
-                    "Sand",
-                    "Coal"
-                ], "correct_option_index": 2, "explanation": "In addition to being one of the most common natural resources on Earth and used in many industries, sand resources are starting to run out!"},
-                
-                {"text": "What is the main producer of oxygen?", "options": [
-                    "Trees",
-                    "Small plants",
-                    "Air",
-                    "Phytoplankton"
-                ], "correct_option_index": 3, "explanation": "It is these marine microorganisms that produce 40 to 60% of oxygen on Earth! Of course, all terrestrial plants also produce oxygen, but on a smaller scale."},
-                
-                {"text": "What is a circular economy?", "options": [
-                    "An economy where the chain 'resource extraction — production — consumption — disposal' is closed in a continuous renewable cycle",
-                    "A model in which the income and expenses of organizations are mutually related to each other",
-                    "A type of economic system characterized by periodic fluctuations in national production, income and employment",
-                    "A model in which there are no fluctuations in national production and employment, and all systems work stably without changes"
-                ], "correct_option_index": 0, "explanation": "It is also called the 'economy of the future' because it is an alternative to the linear economy."},
-                
-                {"text": "This type of waste accounts for up to 10% of global carbon dioxide emissions - more than all international flights and transportation combined", "options": [
-                    "Household waste",
-                    "Restaurant waste",
-                    "Car production waste",
-                    "Clothing production waste"
-                ], "correct_option_index": 3, "explanation": "This figure was provided by the UN Environment Programme, which takes into account not only clothing as household waste, but the entire production cycle."},
-                
-                {"text": "This phenomenon in the ocean is sometimes called the 'new continent', but it has no clear boundaries and significantly harms the marine ecosystem. What is it?", "options": [
-                    "Phytoplankton reproduction",
-                    "A place with the burial of decommissioned ships",
-                    "Great Pacific Garbage Patch",
-                    "Old oil platforms"
-                ], "correct_option_index": 2, "explanation": "The name is serious, the situation is unpleasant. This is a centralized accumulation of garbage from various continents in the upper layers of the Pacific Ocean."}
-            ]
-        },
-        "Nature of Russia": {
-            "Easy": [
-                {"text": "What is the longest river in Russia?", "options": [
-                    "Volga",
-                    "Lena",
-                    "Ob",
-                    "Amur"
-                ], "correct_option_index": 1, "explanation": "Lena is the largest river whose basin lies entirely within Russia. Its length is about 4400km."},
-                
-                {"text": "What is the depth of Lake Baikal?", "options": [
-                    "1100 meters",
-                    "2050 meters",
-                    "898 meters",
-                    "1642 meters"
-                ], "correct_option_index": 3, "explanation": "In addition to being the deepest lake in the world, Lake Baikal is also the largest freshwater lake, containing up to 19% of the world's fresh water supply."},
-                
-                {"text": "What is the name of the highest mountain peak in Russia?", "options": [
-                    "Elbrus",
-                    "Belukha",
-                    "Shota Rustaveli Peak",
-                    "Kazbek"
-                ], "correct_option_index": 0, "explanation": "Elbrus is the highest point in Russia with two five-thousander peaks: 5642 and 5621m."},
-                
-                {"text": "How many subjects does the Russian Federation have?", "options": [
-                    "64",
-                    "89",
-                    "80",
-                    "91"
-                ], "correct_option_index": 1, "explanation": "The Russian Federation consists of 89 subjects."},
-                
-                {"text": "What is the name of the largest city beyond the Arctic Circle?", "options": [
-                    "Apatity",
-                    "Murmansk",
-                    "Severomorsk",
-                    "Tromsø"
-                ], "correct_option_index": 1, "explanation": "Murmansk is considered the largest city in the world beyond the Arctic Circle with a population of 267 thousand people."},
-                
-                {"text": "What is the Golden Ring of Russia?", "options": [
-                    "A tourist route passing through several historical cities of the Golden Ring of Central Russia",
-                    "A term used to denote a circular system of roads connecting million-plus cities of Russia",
-                    "An annual festival of artisans held in the Yaroslavl region",
-                    "The name of the Russian football tournament held among the strongest teams from different regions of the country"
-                ], "correct_option_index": 0, "explanation": "The Golden Ring of Russia is a tourist route passing through ancient cities-centers of folk crafts."}
-            ],
-            "Difficult": [
-                {"text": "Which city in Russia is considered the coldest?", "options": [
-                    "Murmansk",
-                    "Verkhoyansk",
-                    "Norilsk",
-                    "Vorkuta"
-                ], "correct_option_index": 1, "explanation": "In 1982, the weather station in Verkhoyansk recorded an absolute temperature minimum of -67.8 degrees below zero."},
-                
-                {"text": "In which part of Russia are the largest number of geothermal power plants located?", "options": [
-                    "Altai Territory",
-                    "Kamchatka Territory",
-                    "Krasnodar Territory",
-                    "Dagestan"
-                ], "correct_option_index": 1, "explanation": "Geothermal energy is a promising direction. Kamchatka Territory is famous for the Valley of Geysers."},
-                
-                {"text": "What is the name of the northernmost nature reserve in Russia, known as the 'home of polar bears'?", "options": [
-                    "Wrangel Island",
-                    "Kuznetsk Alatau",
-                    "Kivach",
-                    "Teberdinsky Reserve"
-                ], "correct_option_index": 0, "explanation": "The Wrangel Island Reserve is located in the Chukchi Sea area and is a key habitat for the polar bear."},
-                
-                {"text": "Many call this park a 'bird bridge' as it is part of the migration route of tens of millions of birds annually.", "options": [
-                    "Wrangel Island",
-                    "Curonian Spit",
-                    "Coast of the Azov Sea",
-                    "Grigorievskaya Spit"
-                ], "correct_option_index": 1, "explanation": "Locals call the Curonian Spit a 'bird bridge' for a reason - during peak migration, from 1.5 to 2 million individuals are recorded on its territory per day."},
-                
-                {"text": "Seven giants, Mansi blockheads and a sacred mountain. What are we talking about?", "options": [
-                    "Manpupuner",
-                    "Stonehenge",
-                    "Bermamyt Plateau",
-                    "Putorana Plateau"
-                ], "correct_option_index": 0, "explanation": "The unique weathering pillars of Manpupuner in the Northern Urals attract the attention of tens of thousands of tourists every year."},
-                
-                {"text": "What was the first Russian natural object included in the UNESCO World Natural Heritage List?", "options": [
-                    "Curonian Spit",
-                    "Golden Mountains of Altai",
-                    "Lake Baikal",
-                    "Virgin Komi Forests"
-                ], "correct_option_index": 3, "explanation": "The Virgin Komi Forests are untouched forests stretching over an area of 32,600 km²."}
-            ]
-        },
-        "Nuclear Industry": {
-            "Easy": [
-                {"text": "This city is the base of Russia's nuclear icebreaker fleet", "options": [
-                    "Murmansk",
-                    "St. Petersburg",
-                    "Vladivostok",
-                    "Arkhangelsk"
-                ], "correct_option_index": 0, "explanation": "Murmansk is the base of Russia's nuclear icebreaker fleet."},
-                
-                {"text": "For secrecy reasons, the building of the world's first Obninsk NPP was made similar to...", "options": [
-                    "Circus",
-                    "Library",
-                    "Cafe",
-                    "Residential building"
-                ], "correct_option_index": 3, "explanation": "The world's first nuclear power plant in Obninsk was built to resemble a residential building for secrecy reasons."},
-                
-                {"text": "True or myth? The Earth will soon run out of uranium", "options": [
-                    "True",
-                    "Myth"
-                ], "correct_option_index": 1, "explanation": "This is a myth! There is 600 times more uranium on our planet than gold. Experts believe that it will last for another five hundred years."},
-                
-                {"text": "How much CO2 emissions are prevented by the operation of Russian nuclear power plants built in the world at the moment?", "options": [
-                    "20 million tons",
-                    "95 million tons",
-                    "145 million tons",
-                    "217 million tons"
-                ], "correct_option_index": 3, "explanation": "Russian nuclear power plants prevent the emission of 217 million tons of CO2."},
-                
-                {"text": "Where was the world's first nuclear power plant built?", "options": [
-                    "Russia",
-                    "Japan",
-                    "France"
-                ], "correct_option_index": 0, "explanation": "In May 1950, construction of the world's first nuclear power plant began in Obninsk (Kaluga region)."},
-                
-                {"text": "True or myth? All radiation is harmful", "options": [
-                    "True",
-                    "Myth"
-                ], "correct_option_index": 1, "explanation": "But no! In fact, humans are always surrounded by background radiation. But not all radiation is dangerous, the question is in the doses of radiation."}
-            ],
-            "Difficult": [
-                {"text": "Which seas does the Northern Sea Route pass through?", "options": [
-                    "Kara Sea, Laptev Sea, East Siberian Sea, Chukchi Sea, Bering Sea",
-                    "Beaufort Sea, Lincoln Sea, Greenland Sea",
-                    "Barents Sea, White Sea, Okhotsk Sea",
-                    "Baltic Sea, Black Sea, Caspian Sea"
-                ], "correct_option_index": 0, "explanation": "The Northern Sea Route passes through the Kara Sea, Laptev Sea, East Siberian Sea, Chukchi Sea and Bering Sea."},
-                
-                {"text": "This is the world's first nuclear power plant located in the permafrost zone", "options": [
-                    "Beloyarsk NPP",
-                    "Baltic NPP",
-                    "Balakovo NPP",
-                    "Bilibino NPP"
-                ], "correct_option_index": 3, "explanation": "Bilibino NPP is the world's first nuclear power plant located in the permafrost zone."},
-                
-                {"text": "Choose which major projects in the field of accumulated harm elimination Rosatom is engaged in?", "options": [
-                    "City landfill in Chelyabinsk, Industrial site in Usolye-Sibirskoye, Baikal Pulp and Paper Mill, Krasny Bor landfill",
-                    "Yadrovo landfill, Industrial site in Kemerovo",
-                    "All of the above options",
-                    "None of the above options"
-                ], "correct_option_index": 0, "explanation": "Rosatom is engaged in the elimination of accumulated harm at the facilities: City landfill in Chelyabinsk, Industrial site in Usolye-Sibirskoye, Baikal Pulp and Paper Mill, Krasny Bor landfill."},
-                
-                {"text": "Which element is extra? Choose one option:", "options": [
-                    "Indium",
-                    "Uranium",
-                    "Lithium",
-                    "Radium",
-                    "Barium"
-                ], "correct_option_index": 2, "explanation": "The extra element is lithium, it is the only one in this company that is not radioactive."},
-                
-                {"text": "True or myth? It is dangerous to build residential buildings near nuclear power plants.", "options": [
-                    "True",
-                    "Myth"
-                ], "correct_option_index": 1, "explanation": "We live with constant background radiation. It is not dangerous to live near a nuclear power plant; already at a distance of 80 km a person receives a radiation dose of 0.01 millisievert per year."},
-                
-                {"text": "Rosatom includes the world's only floating nuclear power plant. What does it do?", "options": [
-                    "Supplies electricity to the port of Pevek in Chukotka",
-                    "Serves as a transshipment point for Atomflot ships",
-                    "Used to sell electricity to other countries",
-                    "Serves as a floating parking lot for icebreakers"
-                ], "correct_option_index": 0, "explanation": "The world's only floating nuclear power plant 'Akademik Lomonosov' supplies electricity to the Chukotka Autonomous Okrug, primarily the city of Pevek."}
-            ]
-        }
-    }
-}
-
 # ============== QR ==============
-def generate_qr(url):
+def generate_qr(url, box_size=10, fill_color="black", back_color="white"):
+    import qrcode
+
     qr = qrcode.QRCode(
         version=5,
         error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=10,
+        box_size=box_size,
         border=4,
     )
     qr.add_data(url)
     qr.make(fit=True)
-    return qr.make_image(fill_color="black", back_color="white").convert('RGB')
+    return qr.make_image(fill_color=fill_color, back_color=back_color).convert('RGB')
+
+def render_qr_png(url, box_size, fill_color, back_color):
+    buf = io.BytesIO()
+    generate_qr(url, box_size, fill_color, back_color).save(buf, format="PNG")
+    return buf.getvalue()
+
+# Готовые PNG держим в LRU-кэше в памяти; рендер идет в отдельном потоке,
+# одновременные запросы одного и того же QR ждут один рендер
+class QRAssets:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._rendering = {}
+
+    async def png(self, url, box_size=10, fill_color="black", back_color="white"):
+        key = (url, box_size, fill_color, back_color)
+        png = self._cache.get(key)
+        if png is not None:
+            self._cache.move_to_end(key)
+            return png
+        task = self._rendering.get(key)
+        if task is None:
+            task = self._rendering[key] = asyncio.ensure_future(asyncio.to_thread(render_qr_png, *key))
+            task.add_done_callback(lambda _: self._rendering.pop(key, None))
+        png = await asyncio.shield(task)
+        self._cache[key] = png
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return png
+
+    async def prerender(self, url, **style):
+        try:
+            await self.png(url, **style)
+            logging.info(f"✅ QR for {url} pre-rendered")
+        except Exception as e:
+            logging.warning(f"⚠️ QR pre-render failed: {e}")
+
+    async def photo(self, url, **style):
+        return BufferedInputFile(await self.png(url, **style), filename="qr.png")
+
+qr_assets = QRAssets(QR_CACHE_SIZE)
+
+# ============== МЕДИА ==============
+# Статические файлы загружаются в Telegram один раз, дальше отправляем по file_id.
+# file_id сохраняются на диск; ключ включает размер и mtime, чтобы замена файла
+# приводила к повторной загрузке
+class MediaCache:
+    def __init__(self, path):
+        self.path = path
+        self._ids = None
+        self._locks = {}
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._ids = json.load(f)
+        except FileNotFoundError:
+            self._ids = {}
+        except Exception as e:
+            logging.warning(f"⚠️ Media cache is unreadable, starting empty: {e}")
+            self._ids = {}
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._ids, f)
+        os.replace(tmp_path, self.path)
+
+    async def send_photo(self, message, file_path):
+        if self._ids is None:
+            self._load()
+        st = os.stat(file_path)
+        key = f"{file_path}:{st.st_size}:{int(st.st_mtime)}"
+        file_id = self._ids.get(key)
+        if file_id:
+            try:
+                return await message.answer_photo(file_id)
+            except TelegramBadRequest as e:
+                logging.warning(f"⚠️ Cached file_id for {file_path} rejected, re-uploading: {e}")
+                if self._ids.get(key) == file_id:
+                    del self._ids[key]
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        # Пока идет первая загрузка, остальные ждут ее file_id, а не грузят файл параллельно
+        async with lock:
+            file_id = self._ids.get(key)
+            if not file_id:
+                sent = await message.answer_photo(FSInputFile(file_path))
+                self._ids[key] = sent.photo[-1].file_id
+                try:
+                    self._save()
+                except OSError as e:
+                    logging.warning(f"⚠️ Failed to persist media cache: {e}")
+                logging.info(f"📎 Uploaded {file_path}, file_id cached")
+                return sent
+        return await message.answer_photo(file_id)
+
+media_cache = MediaCache(MEDIA_CACHE_PATH)
+
+# ============== FSM-ХРАНИЛИЩЕ ==============
+# Состояние опроса хранится вне процесса, чтобы переживать рестарты и
+# позволять запускать несколько воркеров. Брошенные сессии истекают по TTL.
+def connect_fsm_db(path):
+    db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS fsm ("
+        "key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}', updated REAL NOT NULL)"
+    )
+    db.commit()
+    return db
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        with FSM_LATENCY.time(func.__name__.lstrip("_")):
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        if self._db is None:
+            self._db = connect_fsm_db(self.path)
+        return self._db
+
+    def _get(self, key, column):
+        row = self._connect().execute(
+            f"SELECT {column} FROM fsm WHERE key = ? AND updated > ?", (key, time.time() - self.ttl)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _expire(self, db, key):
+        # Просроченная, но еще не вычищенная сессия не должна "оживать" при записи
+        db.execute("DELETE FROM fsm WHERE key = ? AND updated <= ?", (key, time.time() - self.ttl))
+
+    def _set_state(self, key, state):
+        db = self._connect()
+        self._expire(db, key)
+        db.execute(
+            "INSERT INTO fsm (key, state, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+            (key, state, time.time()),
+        )
+        db.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+        db.commit()
+
+    def _set_data(self, key, data):
+        db = self._connect()
+        self._expire(db, key)
+        db.execute(
+            "INSERT INTO fsm (key, data, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+            (key, data, time.time()),
+        )
+        db.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+        db.commit()
+
+    def _update_data(self, key, changes):
+        db = self._connect()
+        # DELETE в _expire открывает транзакцию с блокировкой на запись, поэтому
+        # чтение и запись ниже атомарны. Семантика - dict.update, как у MemoryStorage
+        # и RedisStorage: ключи верхнего уровня заменяются целиком, None сохраняется
+        self._expire(db, key)
+        row = db.execute("SELECT data FROM fsm WHERE key = ?", (key,)).fetchone()
+        data = json.loads(row[0]) if row else {}
+        data.update(changes)
+        db.execute(
+            "INSERT INTO fsm (key, data, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+            (key, json.dumps(data, ensure_ascii=False, separators=(",", ":")), time.time()),
+        )
+        db.commit()
+        return data
+
+    def _purge(self):
+        db = self._connect()
+        deleted = db.execute("DELETE FROM fsm WHERE updated <= ?", (time.time() - self.ttl,)).rowcount
+        db.commit()
+        return deleted
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await self._run(self._set_state, self.key_builder.build(key), state)
+
+    async def get_state(self, key):
+        return await self._run(self._get, self.key_builder.build(key), "state")
+
+    async def set_data(self, key, data):
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        await self._run(self._set_data, self.key_builder.build(key), payload)
+
+    async def get_data(self, key):
+        data = await self._run(self._get, self.key_builder.build(key), "data")
+        return json.loads(data) if data else {}
+
+    async def update_data(self, key, data):
+        return await self._run(self._update_data, self.key_builder.build(key), dict(data))
+
+    async def purge(self):
+        return await self._run(self._purge)
+
+    def _count(self):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM fsm WHERE updated > ?", (time.time() - self.ttl,)
+        ).fetchone()[0]
+
+    async def count(self):
+        return await self._run(self._count)
+
+    async def close(self):
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=False)
+
+def create_storage():
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "redis":
+        # redis - опциональная зависимость, нужна только для этого режима
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    return SQLiteStorage(FSM_DB, FSM_TTL)
+
+async def fsm_purger(storage):
+    while True:
+        await asyncio.sleep(FSM_PURGE_INTERVAL)
+        try:
+            deleted = await storage.purge()
+            if deleted:
+                logging.info(f"🧹 Purged {deleted} expired quiz sessions")
+        except Exception as e:
+            logging.warning(f"⚠️ FSM purge failed: {e}")
+
+# ============== ОТЛОЖЕННАЯ ОТПРАВКА ==============
+# Один фоновый таск с кучей сроков вместо спящего хендлера на каждый ответ.
+# На чат хранится не больше одной отложенной отправки: новая заменяет старую,
+# а cancel() снимает ее - любую или только заданную функцию
+class DelayedSender:
+    def __init__(self):
+        self._heap = []
+        self._jobs = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._runner = None
+        self._delivering = set()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def schedule(self, chat_id, delay, func, *args):
+        loop = asyncio.get_running_loop()
+        token = next(self._seq)
+        self._jobs[chat_id] = (token, func, args)
+        heapq.heappush(self._heap, (loop.time() + delay, token, chat_id))
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self.run())
+        elif self._heap[0][1] == token:
+            self._wakeup.set()
+
+    def cancel(self, chat_id, func=None):
+        job = self._jobs.get(chat_id)
+        if job is None or (func is not None and job[1] is not func):
+            return False
+        del self._jobs[chat_id]
+        return True
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, token, chat_id = heapq.heappop(self._heap)
+                job = self._jobs.get(chat_id)
+                # Отмененные и замененные задания просто пропускаем
+                if job is None or job[0] != token:
+                    continue
+                del self._jobs[chat_id]
+                self._start(chat_id, job)
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self, chat_id, job):
+        task = asyncio.create_task(self._deliver(chat_id, job[1], job[2]))
+        self._delivering.add(task)
+        task.add_done_callback(self._delivering.discard)
+
+    async def _deliver(self, chat_id, func, args):
+        try:
+            await func(*args)
+        except Exception as e:
+            logging.error(f"❌ Delayed send to {chat_id} failed: {e}")
+
+    async def close(self, timeout):
+        # Отложенное не выбрасываем: результат уже записан, а сессия очищена или
+        # ждет следующий вопрос, и после рестарта прислать это будет некому.
+        # Оставшиеся задания отправляем сразу, не дожидаясь срока
+        if self._runner is not None:
+            self._runner.cancel()
+        jobs, self._jobs = self._jobs, {}
+        self._heap.clear()
+        for chat_id, job in jobs.items():
+            self._start(chat_id, job)
+        if self._delivering:
+            done, pending = await asyncio.wait(list(self._delivering), timeout=timeout)
+            if pending:
+                logging.error(f"❌ {len(pending)} delayed sends did not finish before shutdown")
+
+delayed_sender = DelayedSender()
+
+# ============== ИСХОДЯЩИЕ ЗАПРОСЫ ==============
+# Приоритет отправки: интерактивные ответы идут раньше финальных сообщений
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+send_priority = contextvars.ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        # Возвращает 0, если токен взят, иначе сколько секунд ждать до следующего
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+# Планировщик исходящих запросов поверх сессии бота: token bucket на чат и
+# общий на бота, очередь с приоритетами к общему лимиту и повтор после 429.
+# Лимитируются только методы с chat_id (сообщения), answerCallbackQuery и
+# служебные вызовы идут без ожидания
+class OutboundLimiter(BaseRequestMiddleware):
+    def __init__(self, global_rate, chat_rate, chat_burst, retry_attempts):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retry_attempts = retry_attempts
+        self._global = None
+        self._chats = {}
+        self._waiters = []
+        self._seq = itertools.count()
+        self._pump = None
+        self.chat_waiting = 0
+        self.sent = 0
+        self.retried = 0
+        self.throttled = 0
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters) + self.chat_waiting
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "global_waiting": len(self._waiters),
+            "chat_waiting": self.chat_waiting,
+            "sent": self.sent,
+            "retried": self.retried,
+            "throttled_429": self.throttled,
+        }
+
+    async def _acquire_chat(self, chat_id, loop):
+        now = loop.time()
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._forget_idle_chats(now)
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        delay = bucket.take(now)
+        while delay:
+            self.chat_waiting += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.chat_waiting -= 1
+            delay = bucket.take(loop.time())
+
+    def _forget_idle_chats(self, now):
+        # Полностью восстановившиеся бакеты ничем не отличаются от новых
+        for chat_id, bucket in list(self._chats.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._chats[chat_id]
+
+    async def _acquire_global(self, loop):
+        if self._global is None:
+            self._global = TokenBucket(self.global_rate, self.global_rate, loop.time())
+        if not self._waiters and not self._global.take(loop.time()):
+            return
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (send_priority.get(), next(self._seq), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run_pump(loop))
+        await future
+
+    async def _run_pump(self, loop):
+        while self._waiters:
+            delay = self._global.take(loop.time())
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retry_attempts + 1):
+            await self._acquire_chat(chat_id, loop)
+            await self._acquire_global(loop)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.throttled += 1
+                if attempt == self.retry_attempts:
+                    raise
+                self.retried += 1
+                logging.warning(f"⚠️ Flood control for chat {chat_id}, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+                continue
+            self.sent += 1
+            return response
+
+# Латентность и ошибки самих запросов к Bot API (без ожидания в лимитере)
+class TelegramMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            TELEGRAM_THROTTLED.inc(name)
+            raise
+        except Exception:
+            TELEGRAM_ERRORS.inc(name)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - start, name)
+
+outbound_limiter = OutboundLimiter(TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST, TG_RETRY_ATTEMPTS)
 
 # ============== БОТ ==============
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+# Закэшированные клавиатуры: id объекта -> сам объект. Их JSON считается
+# один раз при первой отправке и дальше подставляется в запрос готовым
+CACHED_MARKUPS = {}
+
+def cached_kb(markup):
+    CACHED_MARKUPS[id(markup)] = markup
+    return markup
+
+def uncache_kb(markup):
+    CACHED_MARKUPS.pop(id(markup), None)
+    if isinstance(bot.session, MarkupCachingSession):
+        bot.session.forget(markup)
+
+class MarkupCachingSession(AiohttpSession):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._markup_json = {}
+
+    def markup_json(self, markup, bot):
+        key = id(markup)
+        if CACHED_MARKUPS.get(key) is not markup:
+            return None
+        dumped = self._markup_json.get(key)
+        if dumped is None:
+            dumped = self._markup_json[key] = self.prepare_value(markup, bot=bot, files={})
+        return dumped
+
+    def forget(self, markup):
+        self._markup_json.pop(id(markup), None)
+
+    def build_form_data(self, bot, method):
+        markup = getattr(method, "reply_markup", None)
+        dumped = self.markup_json(markup, bot) if markup is not None else None
+        if dumped is None:
+            return super().build_form_data(bot, method)
+        form = FormData(quote_fields=False)
+        files = {}
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field("reply_markup", dumped)
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
+bot = Bot(token=BOT_TOKEN, session=MarkupCachingSession(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot.session.middleware(outbound_limiter)
+bot.session.middleware(TelegramMetrics())
+# Апдейты одного чата обрабатываются строго по очереди, разные чаты - параллельно.
+# FSM-middleware aiogram берет эту блокировку до чтения состояния, поэтому
+# второй обработчик видит уже обновленное состояние. Блокировки создаются
+# по требованию и удаляются, когда очередь чата пуста
+class ChatEventIsolation(BaseEventIsolation):
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def lock(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def close(self):
+        self._locks.clear()
+
+# Внутренний middleware: видит конкретный хендлер, поэтому латентность пишется по его имени
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+
+# Диспетчер с хранилищем строит setup_bot(): фронту с несколькими воркерами он не нужен
+dp = None
 
 class QuizStates(StatesGroup):
     choosing_language = State()
@@ -680,40 +1296,22 @@ class QuizStates(StatesGroup):
     choosing_difficulty = State()
     answering = State()
 
-TEXTS = {
-    "ru": {
-        "start": "⚛️ Добро пожаловать в опрос о Росатоме!\n\nВыберите язык:",
-        "name_prompt": "📝 Пожалуйста, укажите ваше имя:",
-        "email_prompt": "📧 Укажите ваш email:",
-        "consent": '🛡️ Нажимая «Подтверждаю», вы даёте согласие на обработку персональных данных в соответствии с политикой конфиденциальности (<a href="https://www.consultant.ru/document/cons_doc_LAW_61801/315f051396c88f1e4f827ba3f2ae313d999a1873/">Федеральный закон от 27.07.2006 N 152-ФЗ</a>).',
-        "already_done": "Вы уже прошли опрос. Спасибо за интерес к Росатому!",
-        "choose_category": "🎯 Выберите направление:",
-        "choose_difficulty": "📊 Выберите уровень сложности:",
-        "quiz_start": "Вопрос {num} из 6:\n\n{question}",
-        "correct": "✅ Верно!\n\nℹ️ {explanation}",
-        "incorrect": "❌ Неверно.\nПравильный ответ: <b>{answer}</b>\n\nℹ️ {explanation}",
-        "explanation": "",
-        "final": "🎉 Поздравляем вас с завершением викторины!\n\nНам было важно сделать викторину максимально разносторонней, чтобы через разъяснения к ответам сделать ее еще и познавательной. Надеемся, вам понравилось.\n\nИ, конечно, мы не могли вас оставить без подарков!\nЧтобы получить приз за участие в викторине, вам необходимо подписаться на телеграм-канал Михи Атомова https://t.me/mixaatomov\n\nДо встречи!",
-        "qr_text": "",
-        "error_saving": "⚠️ Результат не сохранен из-за технической ошибки."
-    },
-    "en": {
-        "start": "⚛️ Welcome to the Rosatom quiz!\n\nChoose your language:",
-        "name_prompt": "📝 Please enter your first name:",
-        "email_prompt": "📧 Please provide your email:",
-        "consent": '🛡️ By clicking "I Agree", you consent to the processing of personal data in accordance with the privacy policy (<a href="https://www.consultant.ru/document/cons_doc_LAW_61801/315f051396c88f1e4f827ba3f2ae313d999a1873/">Federal Law No. 152-FZ of 27.07.2006</a>).',
-        "already_done": "You've already completed the quiz. Thank you for your interest in Rosatom!",
-        "choose_category": "🎯 Choose direction:",
-        "choose_difficulty": "📊 Choose difficulty level:",
-        "quiz_start": "Question {num} out of 6:\n\n{question}",
-        "correct": "✅ Correct!\n\nℹ️ {explanation}",
-        "incorrect": "❌ Incorrect.\nCorrect answer: <b>{answer}</b>\n\nℹ️ {explanation}",
-        "explanation": "",
-        "final": "🎉 Congratulations on completing the quiz!\n\nIt was important for us to make the quiz as versatile as possible, so that through explanations of the answers it would also be educational. We hope you enjoyed it.\n\nAnd of course, we couldn't leave you without gifts!\nTo receive a prize for participating in the quiz, you need to subscribe to the Misha Atmov Telegram channel https://t.me/mixaatomov\n\nSee you!",
-        "qr_text": "",
-        "error_saving": "⚠️ Result not saved due to technical error."
-    }
+# В сессии храним короткие коды (индексы в этих кортежах), а не локализованные строки
+LANGS = ("ru", "en")
+CATEGORIES = ("eco", "nature", "atom")
+DIFFICULTIES = ("easy", "hard")
+CATEGORY_NAMES = {
+    "ru": ("Экологическое просвещение", "Природа России", "Атомная промышленность"),
+    "en": ("Environmental Education", "Nature of Russia", "Nuclear Industry"),
+}
+DIFFICULTY_NAMES = {
+    "ru": ("Полегче", "Посложнее"),
+    "en": ("Easy", "Difficult"),
 }
+PICK_BITS = 3
+
+def session_lang(data):
+    return LANGS[data.get("lang", 0)]
 
 # Клавиатуры
 def lang_kb():
@@ -756,255 +1354,1044 @@ def consent_kb(lang):
     button = InlineKeyboardButton(text=txt, callback_data="consent_yes")
     return InlineKeyboardMarkup(inline_keyboard=[[button]])
 
-def opts_kb(opts, lang):
-    letters = ["A", "B", "C", "D"]
-    buttons = []
-    for i, opt in enumerate(opts):
-        if i < len(letters):
-            buttons.append([InlineKeyboardButton(text=f"{letters[i]}) {opt}", callback_data=f"ans_{i}")])
+OPTION_LETTERS = "ABCDEFGH"
+
+def opts_kb(opts, lang, q_idx):
+    # Номер вопроса в callback_data позволяет отбросить нажатие по старой клавиатуре
+    buttons = [
+        [InlineKeyboardButton(text=f"{OPTION_LETTERS[i]}) {opt}", callback_data=f"ans_{q_idx}_{i}")]
+        for i, opt in enumerate(opts)
+    ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+LANG_KB = cached_kb(lang_kb())
+CATEGORY_KB = {lang: cached_kb(category_kb(lang)) for lang in LANGS}
+DIFFICULTY_KB = {lang: cached_kb(difficulty_kb(lang)) for lang in LANGS}
+CONSENT_KB = {lang: cached_kb(consent_kb(lang)) for lang in LANGS}
+
+# ============== КОНТЕНТ ==============
+# Вопросы и тексты загружаются из CONTENT_DIR, проверяются и компилируются
+# один раз на версию: вопрос адресуется кодами (язык, направление, сложность,
+# номер), а клавиатура и тексты ответов собраны заранее, чтобы на каждый
+# ответ не строить словари и строки
+@dataclass(frozen=True, slots=True)
+class Question:
+    prompt: str
+    options: tuple
+    correct: int
+    keyboard: InlineKeyboardMarkup
+    feedback: tuple
+    # Для компактного режима: разбор ответа вместе со следующим вопросом
+    followup: tuple
+
+@dataclass(frozen=True, slots=True)
+class ContentVersion:
+    version: str
+    texts: dict
+    # Вопросы: [язык][направление][сложность][номер]
+    questions: tuple
+
+# Обязательные тексты и подстановки, которые в них передаются
+TEXT_FIELDS = {
+    "start": (), "name_prompt": (), "email_prompt": (), "consent": (), "already_done": (),
+    "choose_category": (), "choose_difficulty": (), "final": (), "error_saving": (), "quiz_updated": (),
+    "quiz_start": ("num", "question"),
+    "correct": ("explanation",),
+    "incorrect": ("answer", "explanation"),
+}
+# Каждому варианту нужна буква на кнопке, а номер выбранного хранится в PICK_BITS битах
+MAX_OPTIONS = min(len(OPTION_LETTERS), 2 ** PICK_BITS)
+
+def validate_texts(texts):
+    for lang in LANGS:
+        if not isinstance(texts.get(lang), dict):
+            raise ValueError(f"texts.{lang}: missing language")
+        for key, fields in TEXT_FIELDS.items():
+            template = texts[lang].get(key)
+            if not isinstance(template, str):
+                raise ValueError(f"texts.{lang}.{key}: expected a string")
+            try:
+                template.format(**dict.fromkeys(fields, ""))
+            except (KeyError, IndexError, ValueError) as e:
+                raise ValueError(f"texts.{lang}.{key}: bad placeholder {e}")
+
+def validate_question(where, q):
+    if not isinstance(q, dict):
+        raise ValueError(f"{where}: expected an object")
+    for key, kind in (("text", str), ("options", list), ("correct_option_index", int), ("explanation", str)):
+        if not isinstance(q.get(key), kind):
+            raise ValueError(f"{where}.{key}: expected {kind.__name__}")
+    options = q["options"]
+    if not 2 <= len(options) <= MAX_OPTIONS or not all(isinstance(option, str) for option in options):
+        raise ValueError(f"{where}.options: expected 2-{MAX_OPTIONS} strings")
+    if not 0 <= q["correct_option_index"] < len(options):
+        raise ValueError(f"{where}.correct_option_index: out of range")
+
+def question_section(questions, lang, category, difficulty):
+    node = questions
+    for key in (lang, category, difficulty):
+        if not isinstance(node, dict) or key not in node:
+            raise ValueError(f"questions.{lang}.{category}.{difficulty}: missing section")
+        node = node[key]
+    if not isinstance(node, list) or not node:
+        raise ValueError(f"questions.{lang}.{category}.{difficulty}: expected a non-empty list")
+    for num, q in enumerate(node):
+        validate_question(f"questions.{lang}.{category}.{difficulty}[{num}]", q)
+    return node
+
+def compile_question(texts, lang, num, q, prompt, next_prompt):
+    options = tuple(q["options"])
+    correct = q["correct_option_index"]
+    correct_fb = texts["correct"].format(explanation=q["explanation"])
+    incorrect_fb = texts["incorrect"].format(answer=options[correct], explanation=q["explanation"])
+    feedback = tuple(correct_fb if i == correct else incorrect_fb for i in range(len(options)))
+    return Question(
+        prompt=prompt,
+        options=options,
+        correct=correct,
+        keyboard=cached_kb(opts_kb(options, lang, num)),
+        feedback=feedback,
+        followup=tuple(f"{fb}\n\n{next_prompt}" for fb in feedback) if next_prompt else feedback,
+    )
+
+def compile_section(texts, lang, items):
+    prompts = [texts["quiz_start"].format(num=num + 1, question=q["text"]) for num, q in enumerate(items)]
+    prompts.append(None)
+    return tuple(compile_question(texts, lang, num, q, prompts[num], prompts[num + 1]) for num, q in enumerate(items))
+
+def compile_content(version, questions, texts):
+    validate_texts(texts)
+    bank = tuple(
+        tuple(
+            tuple(
+                compile_section(texts[lang], lang, question_section(questions, lang, category, difficulty))
+                for difficulty in DIFFICULTY_NAMES[lang]
+            )
+            for category in CATEGORY_NAMES[lang]
+        )
+        for lang in LANGS
+    )
+    return ContentVersion(version=version, texts=texts, questions=bank)
+
+# Текущая версия подменяется одним присваиванием и только после успешной
+# компиляции: хендлеры видят либо старую версию целиком, либо новую.
+# Сессия запоминает версию, на которой началась, и доходит до конца на ней.
+# Если этой версии в памяти уже нет, опрос начинается заново (restart_quiz)
+class ContentStore:
+    def __init__(self, directory, keep_versions):
+        self.paths = (os.path.join(directory, "questions.json"), os.path.join(directory, "texts.json"))
+        self.keep_versions = keep_versions
+        self.current = None
+        self._versions = OrderedDict()
+        self._signature = None
+
+    def signature(self):
+        # Изменение файлов замечаем по mtime и размеру, не читая их
+        return tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, self.paths))
+
+    def load(self):
+        self._signature = self.signature()
+        raw = []
+        for path in self.paths:
+            with open(path, "rb") as f:
+                raw.append(f.read())
+        # Версия - хэш содержимого: одинаковые файлы дают ту же версию и после рестарта
+        version = hashlib.sha256(b"\0".join(raw)).hexdigest()[:12]
+        if self.current is not None and version == self.current.version:
+            return False
+        content = self._versions.get(version)
+        if content is None:
+            questions, texts = (json.loads(data) for data in raw)
+            content = compile_content(version, questions, texts)
+            self._versions[version] = content
+        self._versions.move_to_end(version)
+        while len(self._versions) > self.keep_versions:
+            _, evicted = self._versions.popitem(last=False)
+            # Клавиатуры вытесненной версии больше не нужны ни в реестре, ни в кэше JSON
+            for lang in evicted.questions:
+                for category in lang:
+                    for section in category:
+                        for q in section:
+                            uncache_kb(q.keyboard)
+        self.current = content
+        return True
+
+    def reload(self):
+        try:
+            changed = self.load()
+        except Exception as e:
+            logging.error(f"❌ Content reload failed, keeping version {self.current.version}: {e}")
+            return False
+        if changed:
+            logging.info(f"📚 Content version {self.current.version} loaded")
+        return changed
+
+    def get(self, version):
+        # None для версии, вытесненной из памяти или оставшейся от прошлого процесса
+        return self._versions.get(version)
+
+    async def watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changed = self.signature() != self._signature
+            except OSError as e:
+                logging.warning(f"⚠️ Content files unavailable: {e}")
+                continue
+            if changed:
+                self.reload()
+
+# Загружается в setup_bot()
+content = ContentStore(CONTENT_DIR, CONTENT_KEEP_VERSIONS)
+
+def session_texts(data):
+    # Набор текстов во всех версиях один и тот же, поэтому, в отличие от
+    # session_questions, пропавшую версию здесь можно заменить текущей
+    version = content.get(data.get("v")) or content.current
+    return version.texts[session_lang(data)]
+
 # ============== ХЕНДЛЕРЫ ==============
-@dp.message(Command("start"))
+# Сообщения хендлеры отправляют сами, через лимитер. Возвращается только
+# callback.answer(): в режиме WEBHOOK_INLINE_REPLY aiogram отдает его прямо в
+# ответе на вебхук, без отдельного запроса к Telegram
 async def start_cmd(message: Message, state: FSMContext):
     uid = message.from_user.id
-    try:
-        if user_exists(uid):
-            await message.answer(TEXTS["ru"]["already_done"])
-            return
-    except Exception as e:
-        logging.error(f"Error checking user: {e}")
-        await message.answer("⚠️ Временные технические неполадки. Начинаем опрос...")
-        
+    # Перезапуск опроса отменяет отложенный вопрос из прошлой попытки. Финал
+    # не трогаем: результат уже записан, и QR участник должен получить
+    delayed_sender.cancel(message.chat.id, send_question)
+    # Ошибки Sheets user_exists_async логирует сам и пропускает участника в опрос
+    if await user_exists_async(uid):
+        await message.answer(content.current.texts["ru"]["already_done"])
+        return
     await state.set_state(QuizStates.choosing_language)
-    await message.answer(TEXTS["ru"]["start"], reply_markup=lang_kb())
+    await message.answer(content.current.texts["ru"]["start"], reply_markup=LANG_KB)
 
-@dp.callback_query(F.data.startswith("lang_"))
 async def lang_cb(callback: CallbackQuery, state: FSMContext):
     lang = callback.data.split("_", 1)[1]
-    await state.update_data(language=lang)
+    # С этого момента сессия закреплена за текущей версией вопросов и текстов
+    current = content.current
+    await state.update_data(lang=LANGS.index(lang), v=current.version)
     await state.set_state(QuizStates.entering_name)
-    await callback.message.edit_text(TEXTS[lang]["name_prompt"])
-    await callback.answer()
+    await callback.message.edit_text(current.texts[lang]["name_prompt"])
+    return callback.answer()
 
-@dp.message(QuizStates.entering_name)
 async def name_msg(message: Message, state: FSMContext):
     name = message.text.strip()
     if len(name) < 2:
-        lang = (await state.get_data()).get("language", "ru")
-        await message.answer(TEXTS[lang]["name_prompt"])
+        await message.answer(session_texts(await state.get_data())["name_prompt"])
         return
-    await state.update_data(name=name)
-    lang = (await state.get_data())["language"]
+    data = await state.update_data(name=name)
     await state.set_state(QuizStates.entering_email)
-    await message.answer(TEXTS[lang]["email_prompt"])
+    await message.answer(session_texts(data)["email_prompt"])
 
-@dp.message(QuizStates.entering_email)
 async def email_msg(message: Message, state: FSMContext):
     email = message.text.strip()
     if "@" not in email or "." not in email:
-        lang = (await state.get_data())["language"]
-        await message.answer(TEXTS[lang]["email_prompt"])
+        await message.answer(session_texts(await state.get_data())["email_prompt"])
         return
-    await state.update_data(email=email)
-    lang = (await state.get_data())["language"]
+    data = await state.update_data(email=email)
     await state.set_state(QuizStates.confirming_consent)
-    await message.answer(TEXTS[lang]["consent"], reply_markup=consent_kb(lang))
+    await message.answer(session_texts(data)["consent"], reply_markup=CONSENT_KB[session_lang(data)])
 
-@dp.callback_query(F.data == "consent_yes")
 async def consent_cb(callback: CallbackQuery, state: FSMContext):
     await state.set_state(QuizStates.choosing_category)
-    lang = (await state.get_data())["language"]
-    await callback.message.edit_text(TEXTS[lang]["choose_category"], reply_markup=category_kb(lang))
-    await callback.answer()
+    data = await state.get_data()
+    await callback.message.edit_text(session_texts(data)["choose_category"], reply_markup=CATEGORY_KB[session_lang(data)])
+    return callback.answer()
 
-@dp.callback_query(F.data.startswith("cat_"))
 async def category_cb(callback: CallbackQuery, state: FSMContext):
-    category_map = {
-        "cat_eco": "Экологическое просвещение" if (await state.get_data())["language"] == "ru" else "Environmental Education",
-        "cat_nature": "Природа России" if (await state.get_data())["language"] == "ru" else "Nature of Russia", 
-        "cat_atom": "Атомная промышленность" if (await state.get_data())["language"] == "ru" else "Nuclear Industry"
-    }
-    
-    category = category_map[callback.data]
-    await state.update_data(category=category)
+    category = CATEGORIES.index(callback.data.split("_", 1)[1])
+    data = await state.update_data(cat=category)
     await state.set_state(QuizStates.choosing_difficulty)
-    lang = (await state.get_data())["language"]
-    await callback.message.edit_text(TEXTS[lang]["choose_difficulty"], reply_markup=difficulty_kb(lang))
-    await callback.answer()
+    await callback.message.edit_text(session_texts(data)["choose_difficulty"], reply_markup=DIFFICULTY_KB[session_lang(data)])
+    return callback.answer()
 
-@dp.callback_query(F.data.startswith("diff_"))
 async def difficulty_cb(callback: CallbackQuery, state: FSMContext):
-    difficulty_map = {
-        "diff_easy": "Полегче" if (await state.get_data())["language"] == "ru" else "Easy",
-        "diff_hard": "Посложнее" if (await state.get_data())["language"] == "ru" else "Difficult"
-    }
-    
-    difficulty = difficulty_map[callback.data]
-    await state.update_data(difficulty=difficulty, answers=[], current_q=0)
+    difficulty = DIFFICULTIES.index(callback.data.split("_", 1)[1])
+    data = await state.update_data(diff=difficulty, q=0, score=0, picks=0)
+    # Вопросы еще не начаты: если версия сессии успела пропасть, берем текущую
+    if content.get(data.get("v")) is None:
+        data = await state.update_data(v=content.current.version)
     await state.set_state(QuizStates.answering)
-    await send_question(callback.message, state)
-    await callback.answer()
+    await send_question(callback.message, state, data)
+    return callback.answer()
 
-async def send_question(message: Message, state: FSMContext):
-    data = await state.get_data()
-    lang = data["language"]
-    category = data["category"]
-    difficulty = data["difficulty"]
-    q_idx = data.get("current_q", 0)
-    
-    # Получаем вопросы для выбранной категории и сложности
-    if lang == "ru":
-        category_key = category
-        difficulty_key = difficulty
-    else:
-        category_key = {
-            "Environmental Education": "Environmental Education",
-            "Nature of Russia": "Nature of Russia", 
-            "Nuclear Industry": "Nuclear Industry"
-        }[category]
-        difficulty_key = {
-            "Easy": "Easy",
-            "Difficult": "Difficult"
-        }[difficulty]
-    
-    questions_list = QUESTIONS[lang][category_key][difficulty_key]
-    
-    if q_idx >= len(questions_list):
-        await finish_quiz(message, state, lang)
+def session_questions(data):
+    version = content.get(data.get("v"))
+    if version is None:
+        return None
+    return version.questions[data["lang"]][data["cat"]][data["diff"]]
+
+# Версии сессии нет в памяти (вытеснена или осталась от прошлого процесса).
+# Продолжать на другом наборе вопросов нельзя: номер вопроса, счет и ответы
+# относятся к старому, поэтому сессию сбрасываем и просим начать заново
+async def restart_quiz(message: Message, state: FSMContext, data):
+    await state.clear()
+    await message.answer(content.current.texts[session_lang(data)]["quiz_updated"])
+
+async def send_question(message: Message, state: FSMContext, data):
+    questions_list = session_questions(data)
+    if questions_list is None:
+        await restart_quiz(message, state, data)
         return
-        
-    q = questions_list[q_idx]
-    txt = TEXTS[lang]["quiz_start"].format(num=q_idx + 1, question=q["text"])
-    await message.answer(txt, reply_markup=opts_kb(q["options"], lang))
+    q = questions_list[data["q"]]
+    await message.answer(q.prompt, reply_markup=q.keyboard)
 
-@dp.callback_query(F.data.startswith("ans_"))
 async def answer_cb(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    lang = data["language"]
-    category = data["category"]
-    difficulty = data["difficulty"]
-    q_idx = data.get("current_q", 0)
-    
-    if lang == "ru":
-        category_key = category
-        difficulty_key = difficulty
-    else:
-        category_key = {
-            "Environmental Education": "Environmental Education",
-            "Nature of Russia": "Nature of Russia",
-            "Nuclear Industry": "Nuclear Industry"
-        }[category]
-        difficulty_key = {
-            "Easy": "Easy",
-            "Difficult": "Difficult"
-        }[difficulty]
-    
-    questions_list = QUESTIONS[lang][category_key][difficulty_key]
+    q_idx = data.get("q", 0)
+    questions_list = session_questions(data)
+    if questions_list is None:
+        await restart_quiz(callback.message, state, data)
+        return callback.answer()
+    parts = callback.data.split("_")
+    try:
+        shown, sel = int(parts[1]), int(parts[2])
+    except (IndexError, ValueError):
+        return callback.answer()
     
-    if q_idx >= len(questions_list):
-        await callback.answer()
-        return
-        
-    sel = int(callback.data.split("_", 1)[1])
+    # Повторное или запоздалое нажатие: на этот вопрос уже ответили. Вариант
+    # проверяем до записи в сессию, чтобы чужой callback_data не испортил счет
+    if len(parts) != 3 or shown != q_idx or q_idx >= len(questions_list):
+        return callback.answer()
     q = questions_list[q_idx]
-    correct = sel == q["correct_option_index"]
-    correct_text = q["options"][q["correct_option_index"]]
-    answers = data.get("answers", [])
-    answers.append({"selected": sel, "correct": correct})
-    await state.update_data(answers=answers, current_q=q_idx + 1)
+    if not 0 <= sel < len(q.options):
+        return callback.answer()
+        
+    # Выбранные варианты упакованы по PICK_BITS бит на вопрос
+    changes = {"q": q_idx + 1, "picks": data["picks"] | (sel << (q_idx * PICK_BITS))}
+    if sel == q.correct:
+        changes["score"] = data["score"] + 1
+    data = await state.update_data(changes)
+    finished = data["q"] >= len(questions_list)
     
-    if correct:
-        fb = TEXTS[lang]["correct"].format(explanation=q["explanation"])
+    if QUIZ_COMPACT and not finished:
+        # Разбор и следующий вопрос - одной правкой того же сообщения
+        await callback.message.edit_text(q.followup[sel], reply_markup=questions_list[data["q"]].keyboard)
     else:
-        fb = TEXTS[lang]["incorrect"].format(answer=correct_text, explanation=q["explanation"])
-    
-    await callback.message.edit_text(fb, reply_markup=None)
-    await callback.answer()
-    await asyncio.sleep(1.5)
-    await send_question(callback.message, state)
+        await callback.message.edit_text(q.feedback[sel], reply_markup=None)
+        # Следующий шаг уходит через планировщик, хендлер не ждет паузу
+        if finished:
+            await finish_quiz(callback.message, state, data)
+        else:
+            delayed_sender.schedule(callback.message.chat.id, NEXT_QUESTION_DELAY, send_question, callback.message, state, data)
+    return callback.answer()
 
-async def finish_quiz(message: Message, state: FSMContext, lang: str):
-    data = await state.get_data()
-    score = sum(1 for a in data["answers"] if a["correct"])
-    uid = message.from_user.id
+# В режиме ответа на вебхук необработанное исключение превращается в 500, и Telegram
+# присылает тот же апдейт снова - поэтому ошибки логируем и считаем обработанными
+async def error_handler(event: ErrorEvent):
+    logging.error(f"❌ Failed to process update {event.update.update_id}: {event.exception!r}", exc_info=event.exception)
+    return True
+
+# Нажатия, не подходящие к текущему шагу (двойной тап, старая клавиатура), просто гасим
+async def stale_cb(callback: CallbackQuery):
+    return callback.answer()
+
+@HANDLER_LATENCY.timed("finish_quiz")
+async def finish_quiz(message: Message, state: FSMContext, data):
+    lang = session_lang(data)
+    score = data["score"]
+    # message здесь - сообщение бота, поэтому берем ID чата (в личке он равен ID пользователя)
+    uid = message.chat.id
     name = data["name"]
     email = data["email"]
-    category = data["category"]
-    difficulty = data["difficulty"]
+    category = CATEGORY_NAMES[lang][data["cat"]]
+    difficulty = DIFFICULTY_NAMES[lang][data["diff"]]
     
     # Сохраняем результат
-    success = append_result(uid, name, email, lang, category, difficulty, score)
-    
+    success = await append_result(uid, name, email, lang, category, difficulty, score)
+    await state.clear()
+    delayed_sender.schedule(uid, NEXT_QUESTION_DELAY, send_final, message, session_texts(data), success)
+
+async def send_final(message: Message, texts, success):
+    send_priority.set(PRIORITY_BACKGROUND)
     if success:
-        final_text = TEXTS[lang]["final"]
+        final_text = texts["final"]
     else:
-        final_text = f"{TEXTS[lang]['final']}\n\n{TEXTS[lang]['error_saving']}"
+        final_text = f"{texts['final']}\n\n{texts['error_saving']}"
     
     await message.answer(final_text)
     
     # Отправка статического QR-кода
     try:
         # Загружаем ваш файл qrcode1.png (должен быть в той же директории)
-        qr_file = FSInputFile("qrcode1.png")
-        await message.answer_photo(qr_file)
+        await media_cache.send_photo(message, QR_FILE)
     except Exception as e:
         logging.error(f"Error sending QR code: {e}")
         # Fallback: генерируем QR код если файл не найден
         try:
-            qr_img = generate_qr(TARGET_URL)
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-                qr_img.save(tmp.name)
-                await message.answer_photo(FSInputFile(tmp.name))
-                os.unlink(tmp.name)
+            await message.answer_photo(await qr_assets.photo(TARGET_URL))
         except Exception as e2:
             logging.error(f"Error generating QR code: {e2}")
-    
-    await state.clear()
+
+# Порядок важен: stale_cb ловит все нажатия, не подошедшие хендлерам выше
+def register_handlers(dp):
+    dp.message.register(start_cmd, Command("start"))
+    dp.callback_query.register(lang_cb, QuizStates.choosing_language, F.data.startswith("lang_"))
+    dp.message.register(name_msg, QuizStates.entering_name)
+    dp.message.register(email_msg, QuizStates.entering_email)
+    dp.callback_query.register(consent_cb, QuizStates.confirming_consent, F.data == "consent_yes")
+    dp.callback_query.register(category_cb, QuizStates.choosing_category, F.data.startswith("cat_"))
+    dp.callback_query.register(difficulty_cb, QuizStates.choosing_difficulty, F.data.startswith("diff_"))
+    dp.callback_query.register(answer_cb, QuizStates.answering, F.data.startswith("ans_"))
+    dp.errors.register(error_handler)
+    dp.callback_query.register(stale_cb)
+
+# ============== POLLING ==============
+# Без публичного URL апдейты забираются пачками через getUpdates. Каждый апдейт
+# встает в цепочку своего чата: апдейты одного чата обрабатываются строго по
+# очереди, разные чаты - параллельно, но не больше concurrency одновременно.
+# Следующий getUpdates уходит сразу, не дожидаясь обработки пачки
+class UpdatePoller:
+    def __init__(self, offset_path, batch, timeout, concurrency, max_pending):
+        self.offset_path = offset_path
+        self.batch = batch
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.processed = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chains = {}  # чат -> последняя задача его цепочки
+        self._inflight = {}  # update_id -> задача
+        self._room = asyncio.Event()
+        self._offset = None
+        self._saved = None
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def _load_offset(self):
+        try:
+            with open(self.offset_path, encoding="utf-8") as f:
+                return json.load(f)["offset"]
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"⚠️ Polling offset file is broken, starting from Telegram's offset: {e}")
+            return None
+
+    def checkpoint(self):
+        # Все апдейты ниже отметки обработаны. После рестарта первый getUpdates
+        # с этой отметкой подтверждает их, и Telegram не пришлет их повторно
+        offset = min(self._inflight) if self._inflight else self._offset
+        if offset is None or offset == self._saved:
+            return
+        tmp_path = f"{self.offset_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"offset": offset}, f)
+        os.replace(tmp_path, self.offset_path)
+        self._saved = offset
+
+    @staticmethod
+    def chat_key(update):
+        event = update.event
+        chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(event, "from_user", None)
+        return user.id if user is not None else None
+
+    async def _process(self, update, previous):
+        if previous is not None:
+            # Ошибки предыдущего апдейта уже залогированы, здесь важен только порядок
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            try:
+                result = await dp.feed_update(bot, update)
+                # Хендлеры нажатий возвращают answerCallbackQuery - в вебхуке его
+                # может выполнить Telegram, здесь отправляем сами
+                if isinstance(result, TelegramMethod):
+                    await bot(result)
+            except Exception as e:
+                logging.error(f"❌ Failed to process update {update.update_id}: {e!r}")
+
+    def _dispatch(self, update):
+        key = self.chat_key(update)
+        task = asyncio.create_task(self._process(update, self._chains.get(key)))
+        self._inflight[update.update_id] = task
+        if key is not None:
+            self._chains[key] = task
+        task.add_done_callback(functools.partial(self._done, update.update_id, key))
+
+    def _done(self, update_id, key, task):
+        del self._inflight[update_id]
+        if self._chains.get(key) is task:
+            del self._chains[key]
+        self.processed += 1
+        self._room.set()
+        if not self._inflight:
+            self.checkpoint()
+
+    async def run(self):
+        self._offset = self._saved = self._load_offset()
+        allowed_updates = dp.resolve_used_update_types()
+        delay = POLLING_RETRY_DELAY
+        webhook_removed = False
+        logging.info(f"📡 Polling started, offset {self._offset}")
+        while True:
+            # Слишком много необработанных апдейтов - новые пока не забираем
+            while len(self._inflight) >= self.max_pending:
+                self._room.clear()
+                await self._room.wait()
+            try:
+                # getUpdates не работает, пока у бота установлен вебхук
+                if not webhook_removed:
+                    await bot.delete_webhook()
+                    webhook_removed = True
+                updates = await bot.get_updates(
+                    offset=self._offset, limit=self.batch, timeout=self.timeout,
+                    allowed_updates=allowed_updates, request_timeout=self.timeout + 10,
+                )
+            except Exception as e:
+                logging.error(f"❌ getUpdates failed, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, POLLING_MAX_RETRY_DELAY)
+                continue
+            delay = POLLING_RETRY_DELAY
+            for update in updates:
+                self._dispatch(update)
+            if updates:
+                self._offset = updates[-1].update_id + 1
+            self.checkpoint()
+
+    async def drain(self, timeout):
+        # Дорабатываем уже полученные апдейты: при следующем запуске Telegram их не пришлет
+        if self._inflight:
+            await asyncio.wait(list(self._inflight.values()), timeout=timeout)
+        self.checkpoint()
+
+poller = UpdatePoller(POLLING_OFFSET_FILE, POLLING_BATCH, POLLING_TIMEOUT, POLLING_CONCURRENCY, POLLING_MAX_PENDING)
 
 # ============== WEBHOOK + HEALTH + PING ==============
+def active_sessions():
+    storage = dp.storage
+    if isinstance(storage, SQLiteStorage):
+        return storage.count()
+    if isinstance(storage, MemoryStorage):
+        return sum(1 for record in storage.storage.values() if record.state)
+    return None
+
+# Контент, диспетчер с FSM-хранилищем и хендлерами и метрики обработки апдейтов
+# нужны только процессу, который сам обрабатывает апдейты: одиночному боту и
+# воркеру. Фронт с несколькими воркерами только пересылает JSON и их не строит
+def setup_bot():
+    global dp
+    if dp is not None:
+        return dp
+    content.load()
+    logging.info(f"📚 Content version {content.current.version} loaded")
+    dp = Dispatcher(storage=create_storage(), events_isolation=ChatEventIsolation())
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    register_handlers(dp)
+    Gauge("quiz_active_sessions", "Quiz sessions stored in FSM storage", active_sessions)
+    Gauge("quiz_delayed_sends", "Scheduled delayed sends", lambda: len(delayed_sender))
+    Gauge("quiz_outbound_queue_depth", "Requests waiting in the outbound limiter", lambda: outbound_limiter.queue_depth)
+    Gauge("quiz_results_pending", "Results not yet sent to Google Sheets", lambda: results_journal.pending_count)
+    Gauge("quiz_participants", "Known participant IDs", lambda: len(participants))
+    Gauge("quiz_polling_inflight", "Polled updates not yet processed", lambda: len(poller))
+    startup_timer.mark("bot setup")
+    return dp
+
+async def metrics_handler(request):
+    return web.Response(text=await render_metrics(), content_type="text/plain", charset="utf-8")
+
+# Liveness: процесс жив и event loop отвечает
 async def health_check(request):
     return web.Response(text="OK", status=200)
 
+# Readiness считается фоновыми пробами и кэшируется, поэтому частые запросы
+# /ready от мониторинга не обращаются ни к Sheets, ни к хранилищу
+class ReadinessMonitor:
+    def __init__(self, interval):
+        self.interval = interval
+        # Последние замеры задержки event loop; в отчет идет максимум, чтобы не терять всплески
+        self.lag_samples = deque([0.0], maxlen=6)
+        self.report = {"ready": False, "checks": {}}
+
+    async def probe_storage(self):
+        storage = dp.storage
+        try:
+            if isinstance(storage, SQLiteStorage):
+                await asyncio.wait_for(storage.count(), self.interval)
+            elif hasattr(storage, "redis"):
+                await asyncio.wait_for(storage.redis.ping(), self.interval)
+            return {"ok": True}
+        except Exception as e:
+            return {"ok": False, "error": repr(e)}
+
+    def sheets_check(self):
+        status = dict(sheets_status)
+        status["age"] = round(time.time() - status["at"], 1) if status["at"] else None
+        # Пока ни одно обращение не завершилось успешно, Sheets считаем недоступным:
+        # проверка подключения идет в фоне, и порт открывается раньше нее
+        status["ok"] = status["ok"] is True
+        return status
+
+    async def refresh(self):
+        depth = outbound_limiter.queue_depth
+        lag = max(self.lag_samples)
+        checks = {
+            "sheets": self.sheets_check(),
+            "storage": await self.probe_storage(),
+            "outbound_queue": {"ok": depth <= READY_MAX_QUEUE_DEPTH, "depth": depth},
+            "event_loop": {"ok": lag <= READY_MAX_LOOP_LAG, "lag": round(lag, 3)},
+            "results_pending": {"ok": True, "count": results_journal.pending_count},
+            "content": {"ok": True, "version": content.current.version},
+        }
+        if not READY_REQUIRE_SHEETS:
+            checks["sheets"]["required"] = False
+        ready = all(check["ok"] for name, check in checks.items() if check.get("required", True))
+        self.report = {"ready": ready, "checks": checks, "updated": round(time.time(), 1)}
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            # Насколько позже запланированного проснулись - это и есть задержка event loop
+            self.lag_samples.append(max(loop.time() - start - self.interval, 0.0))
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.warning(f"⚠️ Readiness probe failed: {e}")
+
+readiness = ReadinessMonitor(READY_PROBE_INTERVAL)
+
+async def ready_check(request):
+    report = readiness.report
+    return web.json_response(report, status=200 if report["ready"] else 503)
+
 # ЭНДПОИНТ ДЛЯ UPTIMEROBOT
 async def ping_handler(request):
     return web.Response(text="pong", status=200)
 
+# aiohttp открывает порт только после возврата из on_startup, поэтому вебхук
+# ставит фоновая задача: Telegram не начнет слать апдейты на порт, который еще
+# не слушается, а медленный Bot API не задерживает bind. При ошибке - повтор
+async def install_webhook():
+    delay = 1
+    while True:
+        try:
+            await bot.set_webhook(
+                WEBHOOK_URL, drop_pending_updates=True, secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        except Exception as e:
+            logging.error(f"❌ Failed to set webhook, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+            continue
+        logging.info(f"Webhook set to {WEBHOOK_URL}")
+        return
+
 async def on_startup(app):
+    app["sheets_refresher"] = asyncio.create_task(sheets_token_refresher())
+    app["participants_syncer"] = asyncio.create_task(participants_syncer())
+    if not participants.loaded:
+        app["sheets_warmup"] = asyncio.create_task(sheets_warmup())
+    await results_journal.open()
+    app["results_replicator"] = asyncio.create_task(results_journal.run())
+    # Журналы воркеров выгружает фронт, одиночный процесс подбирает их сам
+    if "WORKER_ID" not in os.environ:
+        app["orphan_journals"] = asyncio.create_task(replay_orphan_journals({RESULTS_DB}))
+    startup_timer.mark("results journal")
+    # Без статического файла QR понадобится каждому участнику - рендерим заранее
+    if not os.path.exists(QR_FILE):
+        app["qr_prerender"] = asyncio.create_task(qr_assets.prerender(TARGET_URL))
+    await readiness.refresh()
+    app["readiness"] = asyncio.create_task(readiness.run())
+    if isinstance(dp.storage, SQLiteStorage):
+        app["fsm_purger"] = asyncio.create_task(fsm_purger(dp.storage))
+    app["content_watcher"] = asyncio.create_task(content.watch(CONTENT_POLL_INTERVAL))
+    # kill -HUP перечитывает вопросы и тексты, не дожидаясь опроса файлов
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, content.reload)
+    except (AttributeError, NotImplementedError):
+        pass
+    startup_timer.mark("background tasks")
     if WEBHOOK_URL:
-        await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
-        logging.info(f"Webhook set to {WEBHOOK_URL}")
-    else:
+        app["webhook_installer"] = asyncio.create_task(install_webhook())
+    elif POLLING_ENABLED:
+        app["poller"] = asyncio.create_task(poller.run())
         logging.info("Running in polling mode")
+    else:
+        logging.info("No webhook URL and polling disabled, not receiving updates")
+    # Сразу после on_startup aiohttp открывает порт
+    startup_timer.log()
 
 async def on_shutdown(app):
+    if "webhook_installer" in app:
+        app["webhook_installer"].cancel()
+    if "poller" in app:
+        app["poller"].cancel()
+        await poller.drain(POLLING_DRAIN_TIMEOUT)
+    app["readiness"].cancel()
+    if "sheets_warmup" in app:
+        app["sheets_warmup"].cancel()
+    app["content_watcher"].cancel()
+    await delayed_sender.close(DELAYED_DRAIN_TIMEOUT)
+    app["sheets_refresher"].cancel()
+    app["participants_syncer"].cancel()
+    app["results_replicator"].cancel()
+    if "orphan_journals" in app:
+        app["orphan_journals"].cancel()
+    await results_journal.replicate(attempts=3)
+    await results_journal.close()
+    if "fsm_purger" in app:
+        app["fsm_purger"].cancel()
+    await dp.storage.close()
     if WEBHOOK_URL:
         await bot.delete_webhook()
     await bot.session.close()
+    sheets_executor.shutdown(wait=False)
+
+def create_app():
+    setup_bot()
+    app = web.Application()
+    
+    app.router.add_get("/health", health_check)
+    app.router.add_get("/ready", ip_guard(metrics_allowlist)(ready_check))
+    app.router.add_get("/metrics", ip_guard(metrics_allowlist)(metrics_handler))
+    # ДОБАВЛЕНО: IP-фильтр для UptimeRobot
+    app.router.add_get("/ping", ip_guard(ping_allowlist)(ping_handler))
+    # /webhook защищен только secret_token: aiogram сравнивает заголовок
+    # X-Telegram-Bot-Api-Secret-Token через secrets.compare_digest
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, handle_in_background=not WEBHOOK_INLINE_REPLY, secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+# ============== НЕСКОЛЬКО ПРОЦЕССОВ ==============
+# Фронт принимает вебхуки и пересылает каждый апдейт воркеру по ID чата
+# (или пользователя): все апдейты одного участника попадают в один процесс,
+# поэтому его FSM-состояние, отложенные отправки и журнал результатов живут
+# в одном воркере. Воркер - обычный экземпляр бота со своими файлами
+WORKER_METRICS = (
+    Counter("quiz_worker_updates_total", "Webhook updates routed to worker", ("worker",)),
+    Counter("quiz_worker_forward_errors_total", "Updates the worker failed to accept", ("worker",)),
+    Counter("quiz_worker_restarts_total", "Worker process restarts", ("worker",)),
+)
+WORKER_UPDATES, WORKER_FORWARD_ERRORS, WORKER_RESTARTS = WORKER_METRICS
+
+def update_route_key(payload):
+    # Тот же ключ, что и у UpdatePoller.chat_key, только по сырому JSON
+    for name, event in payload.items():
+        if name == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+    return payload.get("update_id", 0)
+
+def add_metric_label(line, label):
+    name, brace, rest = line.partition("{")
+    if brace:
+        return f"{name}{{{label},{rest}"
+    name, _, value = line.partition(" ")
+    return f"{name}{{{label}}} {value}"
+
+# base и base.<N>: у каждого воркера свои журнал результатов и FSM-база.
+# Служебные -wal/-shm файлы SQLite сюда не попадают
+def numbered_files(base):
+    directory, name = os.path.split(base)
+    return sorted(
+        os.path.join(directory, entry) for entry in os.listdir(directory or ".")
+        if entry == name or (entry.startswith(f"{name}.") and entry[len(name) + 1:].isdigit())
+    )
+
+# Журналы, которыми сейчас не владеет ни один процесс: воркеров стало меньше или
+# бот перешел с одного процесса на несколько (и обратно). Без этого их
+# невыгруженные результаты так и не попадут в таблицу
+async def replay_orphan_journals(owned):
+    for path in numbered_files(RESULTS_DB):
+        if path in owned:
+            continue
+        journal = ResultJournal(path, RESULTS_BATCH_SIZE, RESULTS_FLUSH_INTERVAL)
+        await journal.open()
+        try:
+            if journal.pending_count:
+                logging.info(f"📒 Replaying orphaned results journal {path}")
+                await journal.replicate()
+        finally:
+            await journal.close()
+
+# По той же причине чат может оказаться у другого воркера, а его сессия - в
+# чужой или ничьей FSM-базе. Переносим живые сессии владельцу до старта воркеров
+def rehome_fsm_sessions(owner):
+    if FSM_STORAGE in ("memory", "redis"):
+        return
+    moved = 0
+    for source in numbered_files(FSM_DB):
+        db = connect_fsm_db(source)
+        try:
+            rows = db.execute(
+                "SELECT key, state, data, updated FROM fsm WHERE updated > ?", (time.time() - FSM_TTL,)
+            ).fetchall()
+            targets = {}
+            for row in rows:
+                # Ключ DefaultKeyBuilder: fsm:<bot_id>:<chat_id>:<user_id>:<destiny>
+                target = owner(int(row[0].split(":")[2]))
+                if target != source:
+                    targets.setdefault(target, []).append(row)
+            for target, target_rows in targets.items():
+                target_db = connect_fsm_db(target)
+                try:
+                    target_db.executemany(
+                        "INSERT INTO fsm (key, state, data, updated) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                        "updated = excluded.updated WHERE excluded.updated > fsm.updated",
+                        target_rows,
+                    )
+                    target_db.commit()
+                finally:
+                    target_db.close()
+                db.executemany("DELETE FROM fsm WHERE key = ?", [(row[0],) for row in target_rows])
+                db.commit()
+                moved += len(target_rows)
+        finally:
+            db.close()
+    if moved:
+        logging.info(f"🔀 Moved {moved} FSM sessions to the database that now owns their chat")
+
+class WorkerProcess:
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.process = None
+        self.healthy = False
+        self.failures = 0
+        self.stopping = False
+
+    def env(self):
+        env = dict(
+            os.environ,
+            WEB_WORKERS="1",
+            WORKER_ID=str(self.index),
+            PORT=str(self.port),
+            WEB_SERVER_HOST="127.0.0.1",
+            WEBHOOK_SECRET=WEBHOOK_SECRET,
+            # Вебхук ставит фронт, polling воркеру не нужен
+            POLLING_ENABLED="0",
+            FSM_DB=f"{FSM_DB}.{self.index}",
+            RESULTS_DB=f"{RESULTS_DB}.{self.index}",
+            MEDIA_CACHE_PATH=f"{MEDIA_CACHE_PATH}.{self.index}",
+        )
+        env.pop("RENDER_EXTERNAL_URL", None)
+        return env
+
+    async def run(self):
+        delay = WORKER_RESTART_DELAY
+        while not self.stopping:
+            started = time.monotonic()
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), env=self.env()
+            )
+            logging.info(f"👷 Worker {self.index} started, pid {self.process.pid}, port {self.port}")
+            code = await self.process.wait()
+            self.healthy = False
+            if self.stopping:
+                return
+            # Проработавший долго воркер перезапускаем сразу, падающий на старте - с растущей паузой
+            if time.monotonic() - started > WORKER_MAX_RESTART_DELAY:
+                delay = WORKER_RESTART_DELAY
+            WORKER_RESTARTS.inc(str(self.index))
+            logging.error(f"❌ Worker {self.index} exited with code {code}, restarting in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WORKER_MAX_RESTART_DELAY)
+
+    async def check(self, session):
+        try:
+            async with session.get(f"{self.url}/health", timeout=ClientTimeout(total=5)) as response:
+                ok = response.status == 200
+        except (ClientError, asyncio.TimeoutError):
+            ok = False
+        if ok:
+            self.healthy = True
+            self.failures = 0
+            return
+        # Пока воркер ни разу не ответил, он еще стартует
+        if not self.healthy:
+            return
+        self.failures += 1
+        if self.failures >= WORKER_HEALTH_FAILURES and self.process.returncode is None:
+            logging.error(f"❌ Worker {self.index} stopped responding, killing it")
+            self.process.kill()
+            self.healthy = False
+            self.failures = 0
+
+    def signal(self, signum):
+        if self.process is not None and self.process.returncode is None:
+            self.process.send_signal(signum)
+
+    async def stop(self):
+        self.stopping = True
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), WORKER_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.error(f"❌ Worker {self.index} did not stop in {WORKER_STOP_TIMEOUT}s, killing it")
+            self.process.kill()
+            await self.process.wait()
+
+class WebhookFront:
+    def __init__(self, workers):
+        self.workers = workers
+        self.session = None
+
+    def route(self, payload):
+        return self.workers[update_route_key(payload) % len(self.workers)]
+
+    async def webhook(self, request):
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(secret, WEBHOOK_SECRET):
+            return web.Response(body="Unauthorized", status=401)
+        body = await request.read()
+        try:
+            worker = self.route(json.loads(body))
+        except (ValueError, AttributeError, KeyError, TypeError):
+            return web.Response(body="Bad Request", status=400)
+        WORKER_UPDATES.inc(str(worker.index))
+        headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret}
+        try:
+            async with self.session.post(f"{worker.url}{WEBHOOK_PATH}", data=body, headers=headers) as response:
+                # Ответ воркера (в том числе вызов API в теле) отдаем Telegram как есть
+                return web.Response(
+                    body=await response.read(),
+                    status=response.status,
+                    headers={"Content-Type": response.headers.get("Content-Type", "application/octet-stream")},
+                )
+        except (ClientError, asyncio.TimeoutError) as e:
+            WORKER_FORWARD_ERRORS.inc(str(worker.index))
+            logging.warning(f"⚠️ Worker {worker.index} unavailable: {e!r}")
+            # Не 2xx - Telegram доставит апдейт повторно
+            return web.Response(body="Worker unavailable", status=503)
+
+    async def fetch(self, worker, path):
+        try:
+            async with self.session.get(f"{worker.url}{path}", timeout=ClientTimeout(total=5)) as response:
+                if path == "/ready":
+                    return await response.json()
+                return await response.text()
+        except (ClientError, asyncio.TimeoutError, ValueError):
+            return None
+
+    async def ready(self, request):
+        reports = await asyncio.gather(*(self.fetch(worker, "/ready") for worker in self.workers))
+        ready = all(report is not None and report.get("ready") for report in reports)
+        workers = {str(worker.index): report for worker, report in zip(self.workers, reports)}
+        return web.json_response({"ready": ready, "workers": workers}, status=200 if ready else 503)
+
+    async def metrics(self, request):
+        lines = []
+        for metric in WORKER_METRICS:
+            lines.extend(await metric.render())
+        lines += ["# HELP quiz_worker_up Worker answers health checks", "# TYPE quiz_worker_up gauge"]
+        lines += [f'quiz_worker_up{{worker="{worker.index}"}} {int(worker.healthy)}' for worker in self.workers]
+        # Метрики воркеров сливаем по семействам и помечаем номером воркера
+        own = {metric.name for metric in WORKER_METRICS}
+        families = {}
+        texts = await asyncio.gather(*(self.fetch(worker, "/metrics") for worker in self.workers))
+        for worker, text in zip(self.workers, texts):
+            family = None
+            for line in (text or "").splitlines():
+                if line.startswith("# HELP "):
+                    family = line.split(" ", 3)[2]
+                    if family not in families:
+                        families[family] = [line]
+                elif line.startswith("# TYPE "):
+                    if len(families[family]) == 1:
+                        families[family].append(line)
+                elif line and family is not None:
+                    families[family].append(add_metric_label(line, f'worker="{worker.index}"'))
+        for family, family_lines in families.items():
+            if family not in own:
+                lines.extend(family_lines)
+        return web.Response(text="\n".join(lines) + "\n", content_type="text/plain", charset="utf-8")
+
+    async def health_monitor(self):
+        while True:
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL)
+            await asyncio.gather(*(worker.check(self.session) for worker in self.workers))
+
+    async def on_startup(self, app):
+        self.session = ClientSession(connector=TCPConnector(limit=0, limit_per_host=100), timeout=ClientTimeout(total=60))
+        app["workers"] = [asyncio.create_task(worker.run()) for worker in self.workers]
+        app["orphan_journals"] = asyncio.create_task(
+            replay_orphan_journals({worker.env()["RESULTS_DB"] for worker in self.workers})
+        )
+        app["worker_health"] = asyncio.create_task(self.health_monitor())
+        # kill -HUP фронту перечитывает вопросы и тексты во всех воркерах
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGHUP, lambda: [worker.signal(signal.SIGHUP) for worker in self.workers]
+            )
+        except (AttributeError, NotImplementedError):
+            pass
+        if WEBHOOK_URL:
+            app["webhook_installer"] = asyncio.create_task(install_webhook())
+        startup_timer.log()
+
+    async def on_shutdown(self, app):
+        app["worker_health"].cancel()
+        app["orphan_journals"].cancel()
+        if "webhook_installer" in app:
+            app["webhook_installer"].cancel()
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+        for task in app["workers"]:
+            task.cancel()
+        await self.session.close()
+        if WEBHOOK_URL:
+            await bot.delete_webhook()
+        await bot.session.close()
+
+def create_front_app(workers):
+    front = WebhookFront([WorkerProcess(i, WORKER_BASE_PORT + i) for i in range(workers)])
+    app = web.Application()
+    app.router.add_get("/health", health_check)
+    app.router.add_get("/ready", ip_guard(metrics_allowlist)(front.ready))
+    app.router.add_get("/metrics", ip_guard(metrics_allowlist)(front.metrics))
+    app.router.add_get("/ping", ip_guard(ping_allowlist)(ping_handler))
+    app.router.add_post(WEBHOOK_PATH, front.webhook)
+    app.on_startup.append(front.on_startup)
+    app.on_shutdown.append(front.on_shutdown)
+    return app
 
 def main():
     try:
         if not BOT_TOKEN:
             raise EnvironmentError("BOT_TOKEN environment variable is required")
         
-        # Проверяем подключение к Google Sheets
-        try:
-            get_sheet()
-            logging.info("✅ Google Sheets connection successful")
-        except Exception as e:
-            logging.error(f"❌ Google Sheets connection failed: {e}")
-            raise
-        
-        app = web.Application()
+        if WEB_WORKERS > 1:
+            logging.info(f"🚀 Starting webhook front on port {WEB_SERVER_PORT} with {WEB_WORKERS} workers")
+            rehome_fsm_sessions(lambda chat_id: f"{FSM_DB}.{chat_id % WEB_WORKERS}")
+            web.run_app(create_front_app(WEB_WORKERS), host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+            return
         
-        # ДОБАВЛЕНО: IP-фильтр для UptimeRobot
-        app.middlewares.append(ip_middleware)
+        # Проверяем подключение к Google Sheets до открытия порта, только если
+        # так настроено; по умолчанию это делает sheets_warmup после старта
+        if STARTUP_SHEETS_CHECK == "blocking":
+            try:
+                participants.sync(get_sheet())
+                sheets_status.update(ok=True, at=time.time(), error=None)
+                logging.info("✅ Google Sheets connection successful")
+                logging.info(f"👥 Loaded {len(participants)} participants")
+            except Exception as e:
+                logging.error(f"❌ Google Sheets connection failed: {e}")
+                raise
+            startup_timer.mark("sheets check")
         
-        app.router.add_get("/health", health_check)
-        app.router.add_get("/ping", ping_handler)
-        SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=WEBHOOK_PATH)
-        app.on_startup.append(on_startup)
-        app.on_shutdown.append(on_shutdown)
+        if "WORKER_ID" not in os.environ:
+            rehome_fsm_sessions(lambda chat_id: FSM_DB)
+        app = create_app()
+        startup_timer.mark("app setup")
         
         logging.info(f"🚀 Starting bot on port {WEB_SERVER_PORT}")
         logging.info("✅ UptimeRobot monitoring enabled at /ping endpoint")
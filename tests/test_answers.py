@@ -0,0 +1,86 @@
+# Нажатия на варианты ответа: чужой или устаревший callback_data не должен
+# менять сессию, а апдейты одного чата обрабатываются строго по очереди
+import os
+import sys
+import asyncio
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import main
+
+main.setup_bot()
+
+CHAT_ID = 42
+
+class FakeChat:
+    id = CHAT_ID
+
+class FakeMessage:
+    chat = FakeChat()
+
+    def __init__(self):
+        self.edits = []
+
+    async def edit_text(self, text, reply_markup=None):
+        self.edits.append(text)
+
+class FakeCallback:
+    def __init__(self, data):
+        self.data = data
+        self.message = FakeMessage()
+        self.answered = 0
+
+    def answer(self):
+        self.answered += 1
+
+async def press(data, session=None):
+    state = FSMContext(storage=MemoryStorage(), key=StorageKey(bot_id=1, chat_id=CHAT_ID, user_id=CHAT_ID))
+    before = session or {"v": main.content.current.version, "lang": 0, "cat": 0, "diff": 0, "q": 0, "score": 0, "picks": 0}
+    await state.set_state(main.QuizStates.answering)
+    await state.set_data(before)
+    callback = FakeCallback(data)
+    await main.answer_cb(callback, state)
+    main.delayed_sender.cancel(CHAT_ID)
+    return callback, before, await state.get_data()
+
+@pytest.mark.parametrize("data", ["ans_0_9", "ans_0_-1", "ans_0_x", "ans_x_0", "ans_0", "ans_0_1_2", "ans_1_0"])
+def test_bad_or_stale_press_leaves_session_alone(data):
+    callback, before, after = asyncio.run(press(data))
+    assert callback.answered == 1
+    assert callback.message.edits == []
+    assert after == before
+
+def test_valid_press_records_answer():
+    q = main.session_questions({"v": main.content.current.version, "lang": 0, "cat": 0, "diff": 0})[0]
+    sel = len(q.options) - 1
+    callback, before, after = asyncio.run(press(f"ans_0_{sel}"))
+    assert callback.answered == 1
+    assert callback.message.edits == [q.feedback[sel]]
+    assert after["q"] == 1
+    assert after["picks"] == sel
+    assert after["score"] == int(sel == q.correct)
+
+def test_chat_isolation_serializes_one_chat():
+    isolation = main.ChatEventIsolation()
+    events = []
+
+    async def handle(key, name):
+        async with isolation.lock(key):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    async def run():
+        await asyncio.gather(handle("chat:1", "a"), handle("chat:1", "b"), handle("chat:2", "c"))
+        return len(isolation._locks)
+
+    assert asyncio.run(run()) == 0
+    assert events.index("a end") < events.index("b start")
+    # Другой чат не ждет первый
+    assert events.index("c start") < events.index("a end")
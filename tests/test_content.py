@@ -0,0 +1,161 @@
+# Контент: проверка файлов, перезагрузка, вытеснение версий и сессии,
+# чья версия пропала из памяти
+import os
+import sys
+import json
+import shutil
+import asyncio
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import main
+
+main.setup_bot()
+
+def read(directory, name):
+    with open(os.path.join(directory, name), encoding="utf-8") as f:
+        return json.load(f)
+
+def write(directory, name, data):
+    with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+def first_question(questions):
+    category = next(iter(questions["ru"].values()))
+    return next(iter(category.values()))[0]
+
+@pytest.fixture
+def content_dir(tmp_path):
+    for name in ("questions.json", "texts.json"):
+        shutil.copy(os.path.join(main.CONTENT_DIR, name), tmp_path / name)
+    return str(tmp_path)
+
+def test_shipped_content_is_valid(content_dir):
+    store = main.ContentStore(content_dir, 2)
+    assert store.load()
+    assert store.get(store.current.version) is store.current
+
+@pytest.mark.parametrize("breakage, message", [
+    (lambda q, t: t["en"].pop("final"), "texts.en.final"),
+    (lambda q, t: t["ru"].update(correct="{missing}"), "texts.ru.correct"),
+    (lambda q, t: first_question(q).update(options=["a"]), "options"),
+    (lambda q, t: first_question(q).update(options=list("abcdefghi")), "options"),
+    (lambda q, t: first_question(q).update(correct_option_index=7), "correct_option_index"),
+    (lambda q, t: q["en"].popitem(), "missing section"),
+])
+def test_validation_rejects_broken_content(content_dir, breakage, message):
+    questions, texts = read(content_dir, "questions.json"), read(content_dir, "texts.json")
+    breakage(questions, texts)
+    write(content_dir, "questions.json", questions)
+    write(content_dir, "texts.json", texts)
+    with pytest.raises(ValueError, match=message):
+        main.ContentStore(content_dir, 2).load()
+
+def test_every_option_gets_a_button(content_dir):
+    questions = read(content_dir, "questions.json")
+    first_question(questions)["options"] = list("abcdefgh")
+    write(content_dir, "questions.json", questions)
+    store = main.ContentStore(content_dir, 2)
+    store.load()
+    q = store.current.questions[0][0][0][0]
+    assert [row[0].callback_data for row in q.keyboard.inline_keyboard] == [f"ans_0_{i}" for i in range(8)]
+    assert q.keyboard.inline_keyboard[-1][0].text == "H) h"
+
+def test_reload_switches_version_and_keeps_old_on_error(content_dir):
+    store = main.ContentStore(content_dir, 2)
+    store.load()
+    old = store.current
+    assert not store.reload()
+
+    texts = read(content_dir, "texts.json")
+    texts["ru"]["start"] = "Новое приветствие"
+    write(content_dir, "texts.json", texts)
+    assert store.reload()
+    assert store.current.version != old.version
+    assert store.current.texts["ru"]["start"] == "Новое приветствие"
+    # Начатые сессии доигрывают свою версию
+    assert store.get(old.version) is old
+
+    with open(os.path.join(content_dir, "questions.json"), "w", encoding="utf-8") as f:
+        f.write("{broken")
+    current = store.current
+    assert not store.reload()
+    assert store.current is current
+
+def test_eviction_drops_version_and_its_keyboards(content_dir):
+    store = main.ContentStore(content_dir, 2)
+    versions = []
+    for i in range(3):
+        texts = read(content_dir, "texts.json")
+        texts["ru"]["start"] = f"Версия {i}"
+        write(content_dir, "texts.json", texts)
+        store.load()
+        versions.append(store.current)
+    first = versions[0]
+    assert store.get(first.version) is None
+    assert store.get(versions[1].version) is versions[1]
+    assert id(first.questions[0][0][0][0].keyboard) not in main.CACHED_MARKUPS
+    assert id(store.current.questions[0][0][0][0].keyboard) in main.CACHED_MARKUPS
+
+class FakeChat:
+    id = 7
+
+class FakeMessage:
+    chat = FakeChat()
+
+    def __init__(self):
+        self.sent = []
+
+    async def answer(self, text, reply_markup=None):
+        self.sent.append(text)
+
+    async def edit_text(self, text, reply_markup=None):
+        self.sent.append(text)
+
+class FakeCallback:
+    data = "ans_3_0"
+
+    def __init__(self):
+        self.message = FakeMessage()
+
+    def answer(self):
+        return "answered"
+
+def lost_session(lang=1):
+    # Версия осталась от прошлого процесса: в памяти ее нет
+    return {"v": "gone", "lang": lang, "cat": 0, "diff": 0, "q": 3, "score": 2, "picks": 5}
+
+async def answering_state(data):
+    state = FSMContext(storage=MemoryStorage(), key=StorageKey(bot_id=1, chat_id=7, user_id=7))
+    await state.set_state(main.QuizStates.answering)
+    await state.set_data(data)
+    return state
+
+def test_answer_for_lost_version_restarts_quiz():
+    async def run():
+        state = await answering_state(lost_session())
+        callback = FakeCallback()
+        result = await main.answer_cb(callback, state)
+        return result, callback.message.sent, await state.get_state(), await state.get_data()
+
+    result, sent, state, data = asyncio.run(run())
+    assert result == "answered"
+    assert sent == [main.content.current.texts["en"]["quiz_updated"]]
+    assert state is None and data == {}
+
+def test_delayed_question_for_lost_version_restarts_quiz():
+    async def run():
+        state = await answering_state(lost_session(lang=0))
+        message = FakeMessage()
+        await main.send_question(message, state, lost_session(lang=0))
+        return message.sent, await state.get_state()
+
+    sent, state = asyncio.run(run())
+    assert sent == [main.content.current.texts["ru"]["quiz_updated"]]
+    assert state is None
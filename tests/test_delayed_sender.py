@@ -0,0 +1,108 @@
+# DelayedSender: одна отложенная отправка на чат, отмена, замена и досылка при остановке
+import os
+import sys
+import asyncio
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+
+def recorder():
+    sent = []
+
+    async def send(*args):
+        sent.append(args)
+
+    return sent, send
+
+def test_sends_after_delay():
+    sent, send = recorder()
+
+    async def run():
+        sender = main.DelayedSender()
+        sender.schedule(1, 0.05, send, "q1")
+        await asyncio.sleep(0.01)
+        early = list(sent)
+        await asyncio.sleep(0.1)
+        await sender.close(1)
+        return early
+
+    assert asyncio.run(run()) == []
+    assert sent == [("q1",)]
+
+def test_new_job_replaces_pending_one():
+    sent, send = recorder()
+
+    async def run():
+        sender = main.DelayedSender()
+        sender.schedule(1, 0.05, send, "old")
+        sender.schedule(1, 0.05, send, "new")
+        sender.schedule(2, 0.01, send, "other chat")
+        assert len(sender) == 2
+        await asyncio.sleep(0.1)
+        await sender.close(1)
+
+    asyncio.run(run())
+    assert sent == [("other chat",), ("new",)]
+
+def test_cancel():
+    sent, send = recorder()
+
+    async def run():
+        sender = main.DelayedSender()
+        sender.schedule(1, 0.02, send, "q")
+        assert sender.cancel(1)
+        assert not sender.cancel(1)
+        await asyncio.sleep(0.05)
+        await sender.close(1)
+
+    asyncio.run(run())
+    assert sent == []
+
+def test_cancel_only_given_function():
+    sent, send = recorder()
+    other_sent, other = recorder()
+
+    async def run():
+        sender = main.DelayedSender()
+        sender.schedule(1, 0.02, send, "final")
+        # /start снимает только отложенный вопрос, финал должен дойти
+        assert not sender.cancel(1, other)
+        await asyncio.sleep(0.05)
+        await sender.close(1)
+
+    asyncio.run(run())
+    assert sent == [("final",)]
+    assert other_sent == []
+
+def test_close_flushes_pending_jobs():
+    sent, send = recorder()
+
+    async def fail(*args):
+        raise RuntimeError("boom")
+
+    async def run():
+        sender = main.DelayedSender()
+        sender.schedule(1, 60, send, "a")
+        sender.schedule(2, 60, fail)
+        sender.schedule(3, 60, send, "b")
+        await sender.close(1)
+        return len(sender)
+
+    assert asyncio.run(run()) == 0
+    assert sorted(sent) == [("a",), ("b",)]
+
+def test_close_is_bounded():
+    async def hang():
+        await asyncio.sleep(10)
+
+    async def run():
+        sender = main.DelayedSender()
+        sender.schedule(1, 60, hang)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await sender.close(0.05)
+        return loop.time() - start
+
+    assert asyncio.run(run()) < 1
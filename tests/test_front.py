@@ -0,0 +1,107 @@
+# Фронт нескольких воркеров: маршрутизация апдейтов, перенос сессий и журналов
+# при смене числа воркеров, и сам фронт не строит бота
+import os
+import sys
+import json
+import asyncio
+import subprocess
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+import main
+
+USER = {"id": 555, "is_bot": False, "first_name": "u"}
+CHAT = {"id": -1001, "type": "group"}
+
+@pytest.mark.parametrize("payload, key", [
+    ({"update_id": 1, "message": {"message_id": 1, "chat": CHAT, "from": USER}}, -1001),
+    ({"update_id": 2, "edited_message": {"message_id": 1, "chat": CHAT, "from": USER}}, -1001),
+    ({"update_id": 3, "callback_query": {"id": "1", "from": USER, "message": {"message_id": 1, "chat": CHAT}}}, -1001),
+    # Нажатие на кнопку под inline-сообщением: чата нет, маршрут по пользователю
+    ({"update_id": 4, "callback_query": {"id": "1", "from": USER, "inline_message_id": "x"}}, 555),
+    ({"update_id": 5, "inline_query": {"id": "1", "from": USER, "query": ""}}, 555),
+    ({"update_id": 6, "poll": {"id": "p"}}, 6),
+])
+def test_update_route_key(payload, key):
+    assert main.update_route_key(payload) == key
+
+def test_front_does_not_build_the_bot(tmp_path):
+    code = (
+        "import main; main.create_front_app(2); "
+        "print(main.dp is None, main.content.current is None)"
+    )
+    env = dict(os.environ, FSM_DB=str(tmp_path / "fsm.db"), RESULTS_DB=str(tmp_path / "results.db"))
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.split() == ["True", "True"]
+
+async def save_session(path, chat_id, data):
+    storage = main.SQLiteStorage(path, ttl=3600)
+    key = StorageKey(bot_id=1, chat_id=chat_id, user_id=chat_id)
+    await storage.set_state(key, "QuizStates:answering")
+    await storage.set_data(key, data)
+    await storage.close()
+
+async def load_sessions(path):
+    storage = main.SQLiteStorage(path, ttl=3600)
+    rows = await storage._run(lambda: storage._connect().execute("SELECT key, data FROM fsm").fetchall())
+    await storage.close()
+    return {int(key.split(":")[2]): json.loads(data) for key, data in rows}
+
+def test_rehome_fsm_sessions_after_worker_count_change(tmp_path, monkeypatch):
+    base = str(tmp_path / "fsm.db")
+    monkeypatch.setattr(main, "FSM_DB", base)
+    monkeypatch.setattr(main, "FSM_STORAGE", "sqlite")
+    chats = range(10, 18)
+
+    async def run():
+        # Было 4 воркера, стало 3
+        for chat_id in chats:
+            await save_session(f"{base}.{chat_id % 4}", chat_id, {"q": chat_id})
+        main.rehome_fsm_sessions(lambda chat_id: f"{base}.{chat_id % 3}")
+        after = {i: await load_sessions(f"{base}.{i}") for i in range(4)}
+        # Потом вернулись к одному процессу
+        main.rehome_fsm_sessions(lambda chat_id: base)
+        return after, await load_sessions(base)
+
+    after, single = asyncio.run(run())
+    for i in range(3):
+        assert set(after[i]) == {chat_id for chat_id in chats if chat_id % 3 == i}
+    assert after[3] == {}
+    assert set(single) == set(chats)
+    assert single[13] == {"q": 13}
+
+def test_rehome_keeps_newer_session(tmp_path, monkeypatch):
+    base = str(tmp_path / "fsm.db")
+    monkeypatch.setattr(main, "FSM_DB", base)
+
+    async def run():
+        await save_session(f"{base}.1", 4, {"old": True})
+        await save_session(f"{base}.0", 4, {"new": True})
+        main.rehome_fsm_sessions(lambda chat_id: f"{base}.0")
+        return await load_sessions(f"{base}.0"), await load_sessions(f"{base}.1")
+
+    owner, orphan = asyncio.run(run())
+    assert owner == {4: {"new": True}}
+    assert orphan == {}
+
+def test_orphaned_journals_are_replayed(tmp_path, monkeypatch):
+    base = str(tmp_path / "results.db")
+    monkeypatch.setattr(main, "RESULTS_DB", base)
+    written = []
+    monkeypatch.setattr(main, "write_results", lambda rows: written.extend(rows))
+
+    async def run():
+        for path, user in ((base, "single"), (f"{base}.0", "owned"), (f"{base}.5", "orphan")):
+            journal = main.ResultJournal(path, 10, 0.01)
+            await journal.open()
+            await journal.append([user])
+            await journal.close()
+        await main.replay_orphan_journals({f"{base}.0", f"{base}.1"})
+
+    asyncio.run(run())
+    assert sorted(written) == [["orphan"], ["single"]]
@@ -0,0 +1,56 @@
+# SQLiteStorage должен вести себя так же, как MemoryStorage aiogram:
+# одни и те же операции дают одно и то же состояние и данные
+import os
+import sys
+import asyncio
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import main
+
+KEY = StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+UPDATES = [
+    {"a": {"x": 1, "y": 2}, "b": 1},
+    {"a": {"x": 5}, "b": None},
+    {"c": [1, 2], "d": "текст"},
+    {"c": [3]},
+]
+
+async def apply(storage):
+    results = []
+    await storage.set_state(KEY, "QuizStates:answering")
+    for update in UPDATES:
+        results.append(await storage.update_data(KEY, update))
+    results.append(await storage.get_data(KEY))
+    results.append(await storage.get_state(KEY))
+    await storage.set_data(KEY, {})
+    await storage.set_state(KEY, None)
+    results.append(await storage.get_data(KEY))
+    results.append(await storage.get_state(KEY))
+    results.append(await storage.update_data(KEY, {"q": 0}))
+    await storage.close()
+    return results
+
+@pytest.fixture
+def sqlite_storage(tmp_path):
+    return main.SQLiteStorage(str(tmp_path / "fsm.db"), ttl=60)
+
+def test_sqlite_matches_memory_storage(sqlite_storage):
+    assert asyncio.run(apply(sqlite_storage)) == asyncio.run(apply(MemoryStorage()))
+
+def test_update_data_replaces_top_level_keys(sqlite_storage):
+    async def run():
+        await sqlite_storage.update_data(KEY, {"a": {"x": 1, "y": 2}, "b": 1})
+        data = await sqlite_storage.update_data(KEY, {"a": {"x": 5}, "b": None})
+        stored = await sqlite_storage.get_data(KEY)
+        await sqlite_storage.close()
+        return data, stored
+
+    data, stored = asyncio.run(run())
+    assert data == stored == {"a": {"x": 5}, "b": None}
@@ -0,0 +1,77 @@
+# IpAllowlist и определение адреса клиента за прокси
+import os
+import sys
+import asyncio
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import main
+
+def test_blank_and_invalid_entries_are_skipped(caplog):
+    allowlist = main.IpAllowlist.from_config(" 10.0.0.0/8, ,bogus,,300.1.1.1/32, 192.168.1.7 ,", [])
+    assert "10.20.30.40" in allowlist
+    assert "192.168.1.7" in allowlist
+    assert "192.168.1.8" not in allowlist
+    assert "'bogus'" in caplog.text
+    assert "'300.1.1.1/32'" in caplog.text
+
+def test_empty_config_uses_default():
+    allowlist = main.IpAllowlist.from_config("", ["1.2.3.0/24"])
+    assert "1.2.3.4" in allowlist
+    assert "1.2.4.4" not in allowlist
+
+@pytest.mark.parametrize("address, allowed", [
+    ("2001:db8::1", True),
+    ("2001:db8:ffff:ffff:ffff:ffff:ffff:ffff", True),
+    ("2001:db9::", False),
+    ("::1", True),
+    ("::2", False),
+    # IPv4 и IPv6 проверяются по разным таблицам
+    ("0.0.0.1", False),
+])
+def test_ipv6(address, allowed):
+    allowlist = main.IpAllowlist(["2001:db8::/32", "::1"])
+    assert (address in allowlist) is allowed
+
+@pytest.mark.parametrize("address, allowed", [
+    ("10.0.0.0", True),
+    ("10.0.1.255", True),
+    ("10.0.2.0", True),
+    ("10.0.3.255", True),
+    ("10.0.4.0", False),
+    ("9.255.255.255", False),
+    ("10.0.9.1", True),
+])
+def test_overlapping_and_adjacent_ranges(address, allowed):
+    allowlist = main.IpAllowlist(["10.0.0.0/23", "10.0.2.0/23", "10.0.0.0/24", "10.0.9.1"])
+    assert (address in allowlist) is allowed
+
+def test_invalid_address_raises_value_error():
+    with pytest.raises(ValueError):
+        "not-an-ip" in main.IpAllowlist(["10.0.0.0/8"])
+
+@pytest.mark.parametrize("forwarded, hops, expected", [
+    ("1.1.1.1", 1, "1.1.1.1"),
+    # Левые элементы клиент может подделать: берем добавленный доверенным прокси
+    ("6.6.6.6, 1.1.1.1", 1, "1.1.1.1"),
+    ("6.6.6.6, 1.1.1.1, 2.2.2.2", 2, "1.1.1.1"),
+    ("1.1.1.1", 3, "1.1.1.1"),
+    (" , ", 1, None),
+])
+def test_client_ip(forwarded, hops, expected):
+    request = make_mocked_request("GET", "/ping", headers={"X-Forwarded-For": forwarded})
+    assert main.client_ip(request, trusted_hops=hops) == (expected or request.remote)
+
+@pytest.mark.parametrize("forwarded, status", [("10.1.1.1", 200), ("11.1.1.1", 403), ("garbage", 403)])
+def test_ip_guard(forwarded, status):
+    async def handler(request):
+        return web.Response(text="ok")
+
+    guarded = main.ip_guard(main.IpAllowlist(["10.0.0.0/8"]))(handler)
+    request = make_mocked_request("GET", "/ping", headers={"X-Forwarded-For": forwarded})
+    assert asyncio.run(guarded(request)).status == status
@@ -0,0 +1,43 @@
+# Экспозиция метрик и закрытые /metrics и /ready
+import os
+import sys
+import asyncio
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+import main
+
+def test_label_values_are_escaped():
+    counter = main.Counter("test_escape_total", "Escaping", ("call",))
+    main.METRICS.remove(counter)
+    counter.inc('a\\b"c\nd')
+    lines = asyncio.run(counter.render())
+    assert lines[-1] == 'test_escape_total{call="a\\\\b\\"c\\nd"} 1'
+
+def test_histogram_labels_are_escaped():
+    histogram = main.Histogram("test_escape_seconds", "Escaping", ("op",), buckets=(1,))
+    main.METRICS.remove(histogram)
+    histogram.observe(0.5, 'x"y')
+    lines = asyncio.run(histogram.render())
+    assert 'test_escape_seconds_bucket{op="x\\"y",le="1"} 1' in lines
+
+def guarded_routes(app):
+    return {
+        route.resource.canonical: route.handler
+        for route in app.router.routes()
+        if route.method == "GET" and route.resource.canonical in ("/metrics", "/ready")
+    }
+
+@pytest.mark.parametrize("ip, status", [("203.0.113.7", 403), ("10.1.2.3", 200), ("127.0.0.1", 200)])
+def test_metrics_and_ready_are_guarded(ip, status):
+    routes = guarded_routes(main.create_app())
+    assert set(routes) == {"/metrics", "/ready"}
+    main.readiness.report = {"ready": True, "checks": {}}
+    for path, handler in routes.items():
+        request = make_mocked_request("GET", path, headers={"X-Forwarded-For": ip})
+        response = asyncio.run(handler(request))
+        assert response.status == status, path
@@ -0,0 +1,85 @@
+# OutboundLimiter: лимит на чат, повтор после 429 и запросы без chat_id без ожидания
+import os
+import sys
+import asyncio
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, SendMessage
+
+import main
+
+def limiter(chat_rate=100, chat_burst=10, retry_attempts=2):
+    return main.OutboundLimiter(global_rate=1000, chat_rate=chat_rate, chat_burst=chat_burst, retry_attempts=retry_attempts)
+
+class FakeApi:
+    def __init__(self, failures=0, retry_after=0):
+        self.failures = failures
+        self.retry_after = retry_after
+        self.calls = []
+
+    async def __call__(self, bot, method):
+        loop = asyncio.get_running_loop()
+        self.calls.append(loop.time())
+        if len(self.calls) <= self.failures:
+            raise TelegramRetryAfter(method=method, message="Flood control exceeded", retry_after=self.retry_after)
+        return "ok"
+
+def send(chat_id=1):
+    return SendMessage(chat_id=chat_id, text="hi")
+
+def test_retry_after_is_honoured():
+    outbound = limiter()
+    api = FakeApi(failures=2, retry_after=0)
+    assert asyncio.run(outbound(api, None, send())) == "ok"
+    assert len(api.calls) == 3
+    assert outbound.throttled == 2
+    assert outbound.retried == 2
+    assert outbound.sent == 1
+
+def test_retry_waits_retry_after():
+    outbound = limiter()
+    api = FakeApi(failures=1, retry_after=1)
+    assert asyncio.run(outbound(api, None, send())) == "ok"
+    assert api.calls[1] - api.calls[0] >= 0.99
+
+def test_gives_up_after_retry_attempts():
+    outbound = limiter(retry_attempts=1)
+    api = FakeApi(failures=5, retry_after=0)
+    with pytest.raises(TelegramRetryAfter):
+        asyncio.run(outbound(api, None, send()))
+    assert len(api.calls) == 2
+    assert outbound.throttled == 2
+    assert outbound.retried == 1
+    assert outbound.sent == 0
+
+def test_chat_bucket_spaces_messages_of_one_chat():
+    outbound = limiter(chat_rate=20, chat_burst=1)
+    api = FakeApi()
+
+    async def run():
+        await asyncio.gather(*(outbound(api, None, send(1)) for _ in range(3)))
+
+    asyncio.run(run())
+    gaps = [b - a for a, b in zip(api.calls, api.calls[1:])]
+    assert all(gap >= 0.04 for gap in gaps)
+
+def test_other_chats_and_callback_answers_do_not_wait():
+    outbound = limiter(chat_rate=0.5, chat_burst=1)
+    api = FakeApi()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await outbound(api, None, send(1))
+        await outbound(api, None, send(2))
+        for _ in range(5):
+            await outbound(api, None, AnswerCallbackQuery(callback_query_id="1"))
+        return loop.time() - start
+
+    assert asyncio.run(run()) < 0.5
+    assert outbound.sent == 2
+    assert outbound.queue_depth == 0
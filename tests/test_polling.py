@@ -0,0 +1,97 @@
+# UpdatePoller: апдейты одного чата строго по очереди, разных чатов - параллельно,
+# отметка offset сохраняется только за обработанными апдейтами
+import os
+import sys
+import json
+import asyncio
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+from aiogram.types import Update
+
+import main
+
+def message_update(update_id, chat_id):
+    return Update.model_validate({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "u"}, "text": str(update_id),
+    }})
+
+def callback_update(update_id, user_id):
+    # Нажатие под inline-сообщением: чата нет, очередь по пользователю
+    return Update.model_validate({"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "1", "data": "x",
+        "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+    }})
+
+class FakeDispatcher:
+    def __init__(self, delays):
+        self.delays = delays
+        self.events = []
+
+    async def feed_update(self, bot, update):
+        self.events.append(("start", update.update_id))
+        await asyncio.sleep(self.delays.get(update.update_id, 0))
+        self.events.append(("end", update.update_id))
+        if update.update_id in self.delays and self.delays[update.update_id] < 0:
+            raise RuntimeError("handler failed")
+
+@pytest.fixture
+def poller(tmp_path):
+    return main.UpdatePoller(str(tmp_path / "offset.json"), batch=100, timeout=1, concurrency=8, max_pending=100)
+
+def run_updates(monkeypatch, poller, dispatcher, updates):
+    monkeypatch.setattr(main, "dp", dispatcher)
+
+    async def run():
+        for update in updates:
+            poller._dispatch(update)
+        poller._offset = updates[-1].update_id + 1
+        await poller.drain(5)
+
+    asyncio.run(run())
+    return dispatcher.events
+
+def test_one_chat_is_processed_in_order(monkeypatch, poller):
+    # Первый апдейт чата самый медленный, но следующие его ждут
+    dispatcher = FakeDispatcher({1: 0.05, 2: 0.01})
+    events = run_updates(monkeypatch, poller, dispatcher, [message_update(i, 100) for i in (1, 2, 3)])
+    assert events == [("start", 1), ("end", 1), ("start", 2), ("end", 2), ("start", 3), ("end", 3)]
+
+def test_chats_run_in_parallel(monkeypatch, poller):
+    dispatcher = FakeDispatcher({1: 0.05})
+    events = run_updates(monkeypatch, poller, dispatcher, [message_update(1, 100), message_update(2, 200)])
+    assert events.index(("end", 2)) < events.index(("end", 1))
+
+def test_chatless_updates_are_ordered_by_user(monkeypatch, poller):
+    dispatcher = FakeDispatcher({1: 0.05})
+    events = run_updates(monkeypatch, poller, dispatcher, [callback_update(1, 7), callback_update(2, 7)])
+    assert events.index(("end", 1)) < events.index(("start", 2))
+
+def test_failed_update_does_not_break_the_chain(monkeypatch, poller):
+    dispatcher = FakeDispatcher({1: -0.01})
+    events = run_updates(monkeypatch, poller, dispatcher, [message_update(1, 100), message_update(2, 100)])
+    assert ("end", 2) in events
+    assert poller.processed == 2
+    assert len(poller) == 0
+
+def test_checkpoint_after_drain(monkeypatch, poller):
+    dispatcher = FakeDispatcher({})
+    run_updates(monkeypatch, poller, dispatcher, [message_update(i, i) for i in (5, 6)])
+    with open(poller.offset_path, encoding="utf-8") as f:
+        assert json.load(f) == {"offset": 7}
+
+def test_checkpoint_stops_at_unprocessed_update(poller):
+    async def run():
+        slow = asyncio.Event()
+        poller._inflight = {10: asyncio.ensure_future(slow.wait())}
+        poller._offset = 12
+        poller.checkpoint()
+        slow.set()
+        await poller._inflight[10]
+
+    asyncio.run(run())
+    with open(poller.offset_path, encoding="utf-8") as f:
+        assert json.load(f) == {"offset": 10}
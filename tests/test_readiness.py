@@ -0,0 +1,22 @@
+# Readiness: Sheets не считается доступным, пока до него ни разу не достучались
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+
+import main
+
+@pytest.fixture
+def sheets_status():
+    saved = dict(main.sheets_status)
+    yield main.sheets_status
+    main.sheets_status.update(saved)
+
+@pytest.mark.parametrize("ok, expected", [(None, False), (False, False), (True, True)])
+def test_sheets_check(sheets_status, ok, expected):
+    sheets_status.update(ok=ok, at=time.time() if ok is not None else None, error=None)
+    assert main.readiness.sheets_check()["ok"] is expected
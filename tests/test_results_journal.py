@@ -0,0 +1,104 @@
+# Журнал результатов: групповая запись в SQLite и выгрузка в Sheets с повтором
+import os
+import sys
+import asyncio
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+
+import main
+
+def row(user_id):
+    return [str(user_id), "name", "mail@example.com", "ru", "cat", "diff", "3", "2026-01-01 00:00:00"]
+
+@pytest.fixture
+def sheet(monkeypatch):
+    written = []
+    monkeypatch.setattr(main, "write_results", lambda rows: written.extend(rows))
+    monkeypatch.setattr(main, "RESULTS_RETRY_DELAY", 0.01)
+    return written
+
+def test_concurrent_appends_share_commits(tmp_path):
+    journal = main.ResultJournal(str(tmp_path / "results.db"), 100, 60)
+    inserts = []
+
+    async def run():
+        await journal.open()
+        insert = journal._insert
+        journal._insert = lambda rows: (inserts.append(len(rows)), insert(rows))
+        results = await asyncio.gather(*(journal.append(row(i)) for i in range(20)))
+        await journal.close()
+        return results
+
+    assert asyncio.run(run()) == [True] * 20
+    assert sum(inserts) == 20
+    # Пока идет одна запись, остальные копятся и уходят следующей пачкой
+    assert len(inserts) < 20
+    assert journal.pending_count == 20
+
+def test_replicate_sends_in_batches_and_marks_sent(tmp_path, sheet):
+    path = str(tmp_path / "results.db")
+
+    async def run():
+        journal = main.ResultJournal(path, 3, 60)
+        await journal.open()
+        for i in range(7):
+            await journal.append(row(i))
+        assert await journal.replicate()
+        await journal.close()
+        # После рестарта отправленное повторно не уходит
+        reopened = main.ResultJournal(path, 3, 60)
+        await reopened.open()
+        pending = reopened.pending_count
+        assert await reopened.replicate()
+        await reopened.close()
+        return pending
+
+    assert asyncio.run(run()) == 0
+    assert [r[0] for r in sheet] == [str(i) for i in range(7)]
+
+def test_unsent_rows_survive_failure_and_replay_after_restart(tmp_path, monkeypatch):
+    path = str(tmp_path / "results.db")
+    written = []
+    monkeypatch.setattr(main, "RESULTS_RETRY_DELAY", 0.01)
+
+    def broken(rows):
+        raise ConnectionError("sheets down")
+
+    async def run():
+        monkeypatch.setattr(main, "write_results", broken)
+        journal = main.ResultJournal(path, 10, 60)
+        await journal.open()
+        await journal.append(row(1))
+        await journal.append(row(2))
+        assert not await journal.replicate(attempts=2)
+        await journal.close()
+
+        monkeypatch.setattr(main, "write_results", lambda rows: written.extend(rows))
+        reopened = main.ResultJournal(path, 10, 60)
+        await reopened.open()
+        pending = reopened.pending_count
+        assert await reopened.replicate()
+        await reopened.close()
+        return pending
+
+    assert asyncio.run(run()) == 2
+    assert [r[0] for r in written] == ["1", "2"]
+
+def test_reopened_journal_restores_participants(tmp_path, sheet):
+    path = str(tmp_path / "results.db")
+
+    async def run():
+        journal = main.ResultJournal(path, 10, 60)
+        await journal.open()
+        await journal.append(row(987654))
+        await journal.close()
+        main.participants._ids.discard("987654")
+        reopened = main.ResultJournal(path, 10, 60)
+        await reopened.open()
+        await reopened.close()
+
+    asyncio.run(run())
+    assert 987654 in main.participants